@@ -0,0 +1,131 @@
+import argparse
+import heapq
+import random
+from datetime import timedelta
+
+import numpy as np
+
+from scheduling_policy import FifoPolicy, ShortestJobFirstPolicy, DeadlinePolicy
+from bench_fair_share import SimulatedQueue
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Simulate turnaround under FIFO, shortest-expected-job-first and deadline dispatch")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument("--utilization", type=float, default=0.85, help="Offered load relative to fleet capacity")
+    parser.add_argument("--large_fraction", type=float, default=0.3, help="Share of 60s 4K clips, the rest are 3s 480p")
+    parser.add_argument("--deadline", type=float, default=600.0, help="Seconds after upload every task is due")
+    parser.add_argument("--max_wait", type=float, default=900.0, help="Aging threshold of the sjf policy")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+# Ground truth of the simulated fleet: seconds = overhead + units * seconds per unit
+OVERHEAD = 2.0
+SECONDS_PER_UNIT = 0.002
+CLIPS = {
+    'small': dict(frame_count=90, width=854, height=480, objects=1),
+    'large': dict(frame_count=1800, width=3840, height=2160, objects=1),
+}
+
+
+def clip_units(clip):
+    return clip['frame_count'] * clip['width'] * clip['height'] / 1e6 * (1 + clip['objects'])
+
+
+class TrueModel:
+    def predict(self, units, worker=None):
+        return OVERHEAD + SECONDS_PER_UNIT * units
+
+
+class SimulatedCostQueue(SimulatedQueue):
+    def shortest_tasks(self, limit, projection=None):
+        return sorted(self.waiting, key=lambda t: (t['cost']['units'], t['timestamp'], t['task_id']))[:limit]
+
+    def earliest_tasks(self, limit, projection=None):
+        return sorted(self.waiting, key=lambda t: (t['deadline'], t['timestamp'], t['task_id']))[:limit]
+
+
+class SimulatedFifo(SimulatedCostQueue, FifoPolicy):
+    pass
+
+
+class SimulatedShortestJobFirst(SimulatedCostQueue, ShortestJobFirstPolicy):
+    pass
+
+
+class SimulatedDeadline(SimulatedCostQueue, DeadlinePolicy):
+    pass
+
+
+def make_tasks(args):
+    rng = random.Random(args.seed)
+    mean_service = (1 - args.large_fraction) * TrueModel().predict(clip_units(CLIPS['small'])) \
+        + args.large_fraction * TrueModel().predict(clip_units(CLIPS['large']))
+    rate = args.utilization * args.workers / mean_service
+    tasks, t = [], 0.0
+    for index in range(args.tasks):
+        t += rng.expovariate(rate)
+        size = 'large' if rng.random() < args.large_fraction else 'small'
+        units = clip_units(CLIPS[size])
+        # Real processing times scatter around the model
+        service = TrueModel().predict(units) * rng.uniform(0.8, 1.2)
+        tasks.append({'index': index, 'arrival': t, 'size': size, 'units': units, 'service': service})
+    return tasks
+
+
+def simulate(policy, tasks, workers, deadline):
+    """
+    :return: List of (task, turnaround seconds, met deadline).
+    """
+    events = [(task['arrival'], 1, task['index']) for task in tasks]
+    heapq.heapify(events)
+    free = workers
+    results = []
+    while events:
+        policy.clock, kind, index = heapq.heappop(events)
+        task = tasks[index]
+        if kind == 0:
+            free += 1
+            turnaround = policy.clock - task['arrival']
+            results.append((task, turnaround, turnaround <= deadline))
+        else:
+            policy.submit({
+                'task_id': f'{index:06d}', 'index': index, 'user_id': 'user', 'priority': 0,
+                'timestamp': (policy.base + timedelta(seconds=task['arrival'])).isoformat(),
+                'deadline': (policy.base + timedelta(seconds=task['arrival'] + deadline)).isoformat(),
+                'cost': {'units': task['units']},
+            })
+        if events and events[0][0] == policy.clock:
+            continue
+        if free > 0 and policy.waiting:
+            selected = policy.select(free)
+            policy.remove(selected)
+            for entry in selected:
+                heapq.heappush(events, (policy.clock + tasks[entry['index']]['service'], 0, entry['index']))
+                free -= 1
+    return results
+
+
+def report(name, results):
+    turnaround = np.array([seconds for _, seconds, _ in results])
+    missed = sum(1 for _, _, met in results if not met)
+    by_size = {
+        size: np.mean([seconds for task, seconds, _ in results if task['size'] == size])
+        for size in CLIPS
+    }
+    print(f"{name:<10} mean: {np.mean(turnaround):7.1f}s  p50: {np.percentile(turnaround, 50):7.1f}s  "
+          f"p99: {np.percentile(turnaround, 99):7.1f}s  small: {by_size['small']:7.1f}s  "
+          f"large: {by_size['large']:7.1f}s  missed deadlines: {missed}")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    tasks = make_tasks(args)
+
+    print(f"workers: {args.workers}, tasks: {args.tasks}, utilization: {args.utilization:.0%}, "
+          f"large clips: {args.large_fraction:.0%}, deadline: {args.deadline:.0f}s")
+    report("fifo", simulate(SimulatedFifo(), tasks, args.workers, args.deadline))
+    report("sjf", simulate(SimulatedShortestJobFirst(max_wait=args.max_wait), tasks, args.workers, args.deadline))
+    report("deadline", simulate(SimulatedDeadline(model=TrueModel()), tasks, args.workers, args.deadline))
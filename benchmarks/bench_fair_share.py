@@ -0,0 +1,145 @@
+import argparse
+import heapq
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from scheduling_policy import FifoPolicy, FairSharePolicy
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Simulate queue wait times per user under FIFO and fair-share scheduling")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--service_seconds", type=float, default=20.0, help="Mean processing time of a task")
+    parser.add_argument("--burst", type=int, default=50, help="Clips the heavy user uploads at once")
+    parser.add_argument("--light_users", type=int, default=4)
+    parser.add_argument("--light_interval", type=float, default=60.0, help="Mean seconds between uploads of a light user")
+    parser.add_argument("--duration", type=float, default=1800.0, help="Simulated seconds of uploads")
+    parser.add_argument("--max_wait", type=float, default=600.0, help="Aging threshold of the fair policy")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+class SimulatedQueue:
+    """
+    In-memory waiting queue standing in for the Mongo queries of the policies,
+    with a simulated clock. Orders match the indexes the real queries use.
+    """
+    base = datetime(2024, 1, 1)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(None, *args, **kwargs)
+        self.clock = 0.0
+        self.waiting = []
+
+    def now(self):
+        return self.base + timedelta(seconds=self.clock)
+
+    def submit(self, task):
+        self.waiting.append(task)
+
+    def remove(self, tasks):
+        ids = {task['task_id'] for task in tasks}
+        self.waiting = [task for task in self.waiting if task['task_id'] not in ids]
+
+    @staticmethod
+    def by_timestamp(tasks):
+        return sorted(tasks, key=lambda task: (task['timestamp'], task['task_id']))
+
+    def oldest_tasks(self, limit, projection=None):
+        return self.by_timestamp(self.waiting)[:limit]
+
+    def aged_tasks(self, cutoff, limit, projection=None):
+        return self.by_timestamp(t for t in self.waiting if t['timestamp'] < cutoff)[:limit]
+
+    def top_priority(self):
+        if not self.waiting:
+            return False, None
+        return True, max(task['priority'] for task in self.waiting)
+
+    def active_users(self, priority):
+        return sorted({task['user_id'] for task in self.waiting if task['priority'] == priority})
+
+    def user_tasks(self, priority, user_id, limit, projection=None):
+        return self.by_timestamp(
+            t for t in self.waiting if t['priority'] == priority and t['user_id'] == user_id
+        )[:limit]
+
+    def weight(self, user_id):
+        return self.default_weight
+
+
+class SimulatedFifo(SimulatedQueue, FifoPolicy):
+    pass
+
+
+class SimulatedFairShare(SimulatedQueue, FairSharePolicy):
+    pass
+
+
+def make_arrivals(args):
+    rng = random.Random(args.seed)
+    arrivals = [(0.0, 'heavy') for _ in range(args.burst)]
+    for index in range(args.light_users):
+        t = rng.expovariate(1 / args.light_interval)
+        while t < args.duration:
+            arrivals.append((t, f'light_{index}'))
+            t += rng.expovariate(1 / args.light_interval)
+    arrivals.sort()
+    service_rng = random.Random(args.seed + 1)
+    services = [service_rng.expovariate(1 / args.service_seconds) for _ in arrivals]
+    return arrivals, services
+
+
+def simulate(policy, arrivals, services, workers):
+    """
+    Event-driven run: on every arrival or completion the free workers are
+    filled with the tasks the policy selects.
+    :return: user -> list of wait times in seconds.
+    """
+    events = [(t, 1, i) for i, (t, _) in enumerate(arrivals)]
+    heapq.heapify(events)
+    free = workers
+    waits = {}
+    while events:
+        policy.clock, kind, index = heapq.heappop(events)
+        if kind == 0:
+            free += 1
+        else:
+            t, user_id = arrivals[index]
+            policy.submit({
+                'task_id': f'{index:06d}', 'user_id': user_id, 'priority': 0, 'index': index,
+                'timestamp': (policy.base + timedelta(seconds=t)).isoformat(),
+            })
+        if events and events[0][0] == policy.clock:
+            continue
+        if free > 0 and policy.waiting:
+            selected = policy.select(free)
+            policy.remove(selected)
+            for task in selected:
+                t, user_id = arrivals[task['index']]
+                waits.setdefault(user_id, []).append(policy.clock - t)
+                heapq.heappush(events, (policy.clock + services[task['index']], 0, task['index']))
+                free -= 1
+    return waits
+
+
+def report(name, waits):
+    print(name)
+    for user_id in sorted(waits):
+        values = np.array(waits[user_id])
+        print(f"  {user_id:<10} tasks: {len(values):4d}  "
+              f"p50: {np.percentile(values, 50):7.1f}s  p99: {np.percentile(values, 99):7.1f}s")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    arrivals, services = make_arrivals(args)
+
+    print(f"workers: {args.workers}, heavy burst: {args.burst} clips, "
+          f"light users: {args.light_users} (one clip every ~{args.light_interval:.0f}s)")
+    report("fifo", simulate(SimulatedFifo(), arrivals, services, args.workers))
+    report(f"fair share (aging after {args.max_wait:.0f}s)", simulate(
+        SimulatedFairShare(max_wait=args.max_wait, refresh_interval=0), arrivals, services, args.workers
+    ))
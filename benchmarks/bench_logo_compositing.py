@@ -0,0 +1,59 @@
+import argparse
+import time
+
+import numpy as np
+
+from common import place_logo, composite_logo_stream
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark place_logo against LogoCompositor")
+    parser.add_argument("--frames", type=int, default=120)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--logo_size", type=int, default=256)
+    parser.add_argument("--moving", action='store_true', help="Shift the corners by one pixel every frame")
+    return parser.parse_args()
+
+
+def make_inputs(args):
+    rng = np.random.default_rng(0)
+    frames = [
+        rng.integers(0, 255, (args.height, args.width, 3), dtype=np.uint8)
+        for _ in range(args.frames)
+    ]
+    logo = rng.integers(0, 255, (args.logo_size, args.logo_size, 4), dtype=np.uint8)
+    logo[..., 3] = 255
+    base = np.array([[400, 300], [900, 320], [880, 700], [420, 680]], dtype=np.float32)
+    if args.moving:
+        points = [base + i for i in range(args.frames)]
+    else:
+        points = [base] * args.frames
+    return frames, logo, points
+
+
+def bench_place_logo(frames, logo, points):
+    start = time.perf_counter()
+    for frame, pts in zip(frames, points):
+        place_logo(frame, logo, pts)
+    return time.perf_counter() - start
+
+
+def bench_compositor(frames, logo, points):
+    start = time.perf_counter()
+    for _ in composite_logo_stream(frames, logo, points):
+        pass
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    frames, logo, points = make_inputs(args)
+
+    baseline = bench_place_logo(frames, logo, points)
+    batched = bench_compositor(frames, logo, points)
+
+    print(f"frames: {args.frames} at {args.width}x{args.height}, moving={args.moving}")
+    print(f"place_logo loop:  {baseline:.3f}s ({args.frames / baseline:.1f} fps)")
+    print(f"LogoCompositor:   {batched:.3f}s ({args.frames / batched:.1f} fps)")
+    print(f"speedup:          {baseline / batched:.2f}x")
@@ -0,0 +1,68 @@
+import argparse
+import time
+
+import numpy as np
+
+from common import color_palette, get_color_masks, blend_frames_with_colored_masks, iter_blended_frames
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the mask overlay renderer")
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--objects", type=int, default=10)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    return parser.parse_args()
+
+
+def make_inputs(args):
+    rng = np.random.default_rng(0)
+    frames = [
+        rng.integers(0, 255, (args.height, args.width, 3), dtype=np.uint8)
+        for _ in range(args.frames)
+    ]
+    yy, xx = np.mgrid[:args.height, :args.width]
+    masks = []
+    for _ in range(args.objects):
+        cy, cx = rng.integers(0, args.height), rng.integers(0, args.width)
+        radius = rng.integers(args.height // 10, args.height // 3)
+        masks.append(((yy - cy) ** 2 + (xx - cx) ** 2 < radius ** 2).astype(np.uint8))
+    return frames, [masks] * args.frames
+
+
+def bench_loop(frames, masks_per_frame):
+    start = time.perf_counter()
+    overlays = [get_color_masks_loop(masks) for masks in masks_per_frame]
+    blend_frames_with_colored_masks(frames, overlays)
+    return time.perf_counter() - start
+
+
+def get_color_masks_loop(masks, colors=color_palette):
+    # Per-object loop as get_color_masks was implemented before the label map renderer
+    colored_overlay = np.zeros((*masks[0].shape, 3), np.uint8)
+    for mask, color in zip(masks, colors):
+        mask = (mask > 0).astype(np.uint8)
+        colored_overlay[mask > 0] = color
+    return colored_overlay
+
+
+def bench_renderer(frames, masks_per_frame):
+    start = time.perf_counter()
+    for _ in iter_blended_frames(frames, masks_per_frame):
+        pass
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    frames, masks_per_frame = make_inputs(args)
+
+    assert np.array_equal(get_color_masks(masks_per_frame[0]), get_color_masks_loop(masks_per_frame[0]))
+
+    baseline = bench_loop(frames, masks_per_frame)
+    rendered = bench_renderer(frames, masks_per_frame)
+
+    print(f"frames: {args.frames}, objects: {args.objects}, {args.width}x{args.height}")
+    print(f"per-object loop:      {baseline:.3f}s ({baseline / args.frames * 1000:.1f} ms/frame)")
+    print(f"MaskOverlayRenderer:  {rendered:.3f}s ({rendered / args.frames * 1000:.1f} ms/frame)")
+    print(f"speedup:              {baseline / rendered:.2f}x")
@@ -0,0 +1,223 @@
+import os
+import json
+import zlib
+import fcntl
+import shutil
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+CHUNK_SIZE = 1 << 20
+STATE_FILE = 'upload.json'
+LOCK_FILE = 'upload.lock'
+PART_FILE = 'video.part'
+PENDING_DIR = '.uploads'
+
+
+class UploadError(Exception):
+    """
+    Raised by ChunkedUploadStore with the HTTP status the route should answer with.
+    """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class ChunkedUploadStore:
+    """
+    Resumable, chunked uploads written straight into blob storage.
+
+    An upload lives in blob_storage/<upload_id>, the folder that becomes the
+    task folder on finalize. Chunks must arrive in order (the client asks for
+    the current offset to resume) and are written with os.pwrite at their
+    offset into a preallocated video.part file. A CRC32 of the bytes received
+    so far is carried in the state file, so the whole file is verified on
+    finalize without reading it again. Finalize renames video.part in place.
+
+    Every upload in progress has a marker in blob_storage/.uploads, so
+    expire() finds abandoned uploads without listing the task folders and
+    removes those older than `max_age`. The declared size of an upload counts
+    in the StorageAccounting usage from init until it is finalized or expired.
+
+    :param blob_storage: Root directory of the task folders.
+    :param max_size: Largest accepted upload in bytes.
+    :param max_age: Seconds after which an upload that was not finalized is removed.
+    :param storage: Optional StorageAccounting charged with the uploads in progress.
+    """
+    def __init__(self, blob_storage, max_size=2 << 30, max_age=24 * 3600, storage=None):
+        self.blob_storage = Path(blob_storage)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.storage = storage
+        self.pending_dir = self.blob_storage / PENDING_DIR
+        self.pending_dir.mkdir(parents=True, exist_ok=True)
+
+    def upload_dir(self, upload_id):
+        # upload_id comes from the URL, refuse anything that is not a plain folder name
+        if not upload_id or os.path.basename(upload_id) != upload_id or upload_id.startswith('.'):
+            raise UploadError('Invalid upload id', 400)
+        return self.blob_storage / upload_id
+
+    @contextmanager
+    def locked(self, upload_id):
+        upload_dir = self.upload_dir(upload_id)
+        if not (upload_dir / STATE_FILE).exists():
+            raise UploadError('Upload not found', 404)
+        with open(upload_dir / LOCK_FILE, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # A concurrent finalize may have completed while we waited for the lock
+                if not (upload_dir / STATE_FILE).exists():
+                    raise UploadError('Upload not found', 404)
+                yield upload_dir
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def read_state(upload_dir):
+        with open(upload_dir / STATE_FILE, 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def write_state(upload_dir, state):
+        tmp_path = upload_dir / (STATE_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, upload_dir / STATE_FILE)
+
+    def check_owner(self, state, token):
+        if state['token'] != token:
+            raise UploadError('Upload belongs to another token', 403)
+
+    def init(self, upload_id, token, data, size):
+        """
+        Create the upload folder and preallocate the file.
+        :param data: Task description as sent in the 'data' field of /upload_task.
+        :param size: Total size of the video in bytes.
+        :return: The upload state.
+        """
+        if not 0 < size <= self.max_size:
+            raise UploadError(f'Upload size must be between 1 and {self.max_size} bytes', 413)
+        upload_dir = self.upload_dir(upload_id)
+        upload_dir.mkdir(parents=True, exist_ok=False)
+        fd = os.open(upload_dir / PART_FILE, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.truncate(fd, size)
+        finally:
+            os.close(fd)
+        state = {
+            'upload_id': upload_id,
+            'token': token,
+            'data': data,
+            'size': size,
+            'offset': 0,
+            'crc32': 0,
+            'created_at': datetime.now().isoformat(),
+        }
+        self.write_state(upload_dir, state)
+        (self.pending_dir / upload_id).touch()
+        if self.storage is not None:
+            self.storage.add_usage(token, size)
+        return state
+
+    def status(self, upload_id, token):
+        upload_dir = self.upload_dir(upload_id)
+        if not (upload_dir / STATE_FILE).exists():
+            raise UploadError('Upload not found', 404)
+        state = self.read_state(upload_dir)
+        self.check_owner(state, token)
+        return state
+
+    def write_chunk(self, upload_id, token, start, end, total, stream, chunk_crc32=None):
+        """
+        Write the byte range [start, end] (inclusive, like Content-Range) read from `stream`.
+        :param chunk_crc32: Optional CRC32 of the chunk sent by the client.
+        :return: The updated upload state.
+        """
+        with self.locked(upload_id) as upload_dir:
+            state = self.read_state(upload_dir)
+            self.check_owner(state, token)
+            if total != state['size'] or end >= state['size'] or end < start:
+                raise UploadError('Content-Range does not match the upload', 416)
+            if start != state['offset']:
+                raise UploadError(f"Expected a chunk starting at {state['offset']}", 409)
+
+            expected = end - start + 1
+            written = 0
+            chunk_crc = 0
+            # Chunks arrive in order, so the file CRC continues from the stored prefix CRC
+            file_crc = state['crc32']
+            fd = os.open(upload_dir / PART_FILE, os.O_WRONLY)
+            try:
+                while written < expected:
+                    chunk = stream.read(min(CHUNK_SIZE, expected - written))
+                    if not chunk:
+                        break
+                    os.pwrite(fd, chunk, start + written)
+                    chunk_crc = zlib.crc32(chunk, chunk_crc)
+                    file_crc = zlib.crc32(chunk, file_crc)
+                    written += len(chunk)
+            finally:
+                os.close(fd)
+
+            if written != expected:
+                raise UploadError(f'Chunk truncated, received {written} of {expected} bytes', 400)
+            if chunk_crc32 is not None and chunk_crc32 != chunk_crc:
+                raise UploadError('Chunk checksum mismatch', 422)
+
+            state['crc32'] = file_crc
+            state['offset'] = end + 1
+            self.write_state(upload_dir, state)
+            return state
+
+    def finalize(self, upload_id, token, crc32=None):
+        """
+        Verify the upload is complete and move video.part to video.mp4 in place.
+        :param crc32: Optional CRC32 of the whole file sent by the client.
+        :return: (state, path of the finished video).
+        """
+        with self.locked(upload_id) as upload_dir:
+            state = self.read_state(upload_dir)
+            self.check_owner(state, token)
+            if state['offset'] != state['size']:
+                raise UploadError(f"Upload incomplete, {state['offset']} of {state['size']} bytes received", 409)
+            if crc32 is not None and crc32 != state['crc32']:
+                raise UploadError('File checksum mismatch', 422)
+            video_path = upload_dir / 'video.mp4'
+            os.replace(upload_dir / PART_FILE, video_path)
+            os.remove(upload_dir / STATE_FILE)
+        os.remove(upload_dir / LOCK_FILE)
+        self.forget(state)
+        return state, str(video_path)
+
+    def forget(self, state):
+        (self.pending_dir / state['upload_id']).unlink(missing_ok=True)
+        # From here on the video is accounted by whoever keeps it
+        if self.storage is not None:
+            self.storage.add_usage(state['token'], -state['size'])
+
+    def expire(self):
+        """
+        Remove the uploads started more than max_age seconds ago and never finalized.
+        :return: (uploads removed, bytes of declared size released).
+        """
+        cutoff = (datetime.now() - timedelta(seconds=self.max_age)).isoformat()
+        removed, released = 0, 0
+        for marker in list(self.pending_dir.iterdir()):
+            try:
+                with self.locked(marker.name) as upload_dir:
+                    state = self.read_state(upload_dir)
+                    if state['created_at'] >= cutoff:
+                        continue
+                    # A writer waiting for the lock finds no state file and answers 404
+                    shutil.rmtree(upload_dir, ignore_errors=True)
+            except UploadError:
+                # Finalized or removed in the meantime
+                marker.unlink(missing_ok=True)
+                continue
+            self.forget(state)
+            removed += 1
+            released += state['size']
+        return removed, released
@@ -6,11 +6,17 @@ from pathlib import Path
 import requests  # Ensure requests is installed
 
 from scipy.ndimage import zoom
-from skimage.measure import label
 
 from apns2.client import APNsClient
 from apns2.payload import Payload
 import collections
+import contextlib
+import functools
+import queue
+import threading
+import time
+
+from video_pool import video_pool
 
 dcn = lambda x: x.detach().cpu().numpy()
 
@@ -62,52 +68,232 @@ def place_logo(source, logo, pts_src):
     return result
 
 
+class LogoCompositor:
+    """
+    Alpha-blend a BGRA logo onto a sequence of frames in place.
+
+    Unlike place_logo, the homography is only recomputed when the corner
+    points move by more than `tolerance` pixels, the logo is warped into its
+    bounding ROI instead of a full-frame canvas, and blending uses the
+    fractional alpha channel with buffers that are reused between frames.
+
+    :param logo: BGRA logo image.
+    :param tolerance: Max corner displacement in pixels that reuses the cached homography.
+    """
+    def __init__(self, logo, tolerance=0.0):
+        if logo.ndim != 3 or logo.shape[2] != 4:
+            raise ValueError(f"logo must be a BGRA image, got shape {logo.shape}")
+        self.logo = np.ascontiguousarray(logo)
+        self.tolerance = tolerance
+        h, w = logo.shape[:2]
+        self.pts_logo = np.array([[0, 0], [w-1, 0], [w-1, h-1], [0, h-1]], dtype=np.float32)
+        self.cached_pts = None
+        self.frame_size = None
+        self.roi = None
+        self.homography = None
+        self.warped = None
+        self.alpha = None
+        self.blend = None
+
+    def _points_changed(self, pts_src, frame_size):
+        if self.cached_pts is None or frame_size != self.frame_size:
+            return True
+        return np.abs(pts_src - self.cached_pts).max() > self.tolerance
+
+    def _update_geometry(self, pts_src, frame_size):
+        frame_h, frame_w = frame_size
+        x, y, w, h = cv2.boundingRect(pts_src)
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, frame_w), min(y + h, frame_h)
+        self.cached_pts = pts_src
+        self.frame_size = frame_size
+        if x1 <= x0 or y1 <= y0:
+            self.roi = None
+            return
+        # Shift the homography so that the ROI origin maps to (0, 0)
+        shift = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]], dtype=np.float64)
+        homography = cv2.getPerspectiveTransform(self.pts_logo, pts_src)
+        self.homography = shift @ homography
+        self.roi = (y0, y1, x0, x1)
+        roi_shape = (y1 - y0, x1 - x0)
+        if self.warped is None or self.warped.shape[:2] != roi_shape:
+            self.warped = np.empty((*roi_shape, 4), np.uint8)
+            self.alpha = np.empty((*roi_shape, 1), np.float32)
+            self.blend = np.empty((*roi_shape, 3), np.float32)
+
+    def composite(self, frame, pts_src):
+        """
+        Blend the logo into `frame` (BGR, modified in place) at the corners
+        `pts_src` ordered like order_points. Returns the same frame.
+        """
+        pts_src = np.asarray(pts_src, dtype=np.float32).reshape(4, 2)
+        frame_size = frame.shape[:2]
+        if self._points_changed(pts_src, frame_size):
+            self._update_geometry(pts_src, frame_size)
+        if self.roi is None:
+            return frame
+
+        y0, y1, x0, x1 = self.roi
+        roi_shape = (x1 - x0, y1 - y0)
+        cv2.warpPerspective(self.logo, self.homography, roi_shape, dst=self.warped)
+        np.multiply(self.warped[..., 3:], 1.0 / 255, out=self.alpha)
+
+        # frame_roi += alpha * (logo - frame_roi), computed in float then rounded back
+        frame_roi = frame[y0:y1, x0:x1]
+        np.subtract(self.warped[..., :3], frame_roi, out=self.blend, dtype=np.float32)
+        self.blend *= self.alpha
+        self.blend += frame_roi
+        self.blend += 0.5
+        np.copyto(frame_roi, self.blend, casting='unsafe')
+        return frame
+
+
+def composite_logo_stream(frames, logo, pts_src, tolerance=0.0):
+    """
+    Composite `logo` over every frame of `frames` in place and yield the frames.
+
+    :param frames: Iterable of BGR frames.
+    :param logo: BGRA logo image.
+    :param pts_src: Either one (4, 2) array of corners used for every frame,
+                    or an iterable with one such array per frame.
+    :param tolerance: See LogoCompositor.
+    """
+    compositor = LogoCompositor(logo, tolerance)
+    if isinstance(pts_src, np.ndarray) and pts_src.ndim == 2:
+        for frame in frames:
+            yield compositor.composite(frame, pts_src)
+    else:
+        for frame, frame_pts in zip(frames, pts_src):
+            yield compositor.composite(frame, frame_pts)
+
+
 def get_frame(video_path, frame_number):
-    video = cv2.VideoCapture(video_path)
-    video.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-    success, image = video.read()
-    image = cv2.cvtColor(image,cv2.COLOR_BGR2RGB)
-    video.release()
-    return image
-
-
-def frame_extraction(video_path):
-    frames = []
-    vid = cv2.VideoCapture(video_path)
-    flag, frame = vid.read()
-    cnt = 0
-    new_h, new_w = None, None
-    while flag:
-        frames.append(frame)
-        flag, frame = vid.read()
-    frames = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in frames]
-    return frames
-
-
-def frame_extraction_rgba(video_path):
-    frames = []
-    vid = cv2.VideoCapture(video_path)
-    flag,frame = vid.read()
-    while flag:
-        frames.append(frame)
-        flag, frame = vid.read()
-    frames = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA) for frame in frames]
-    return frames
+    # Frame 0 is served from the shared read-only thumbnail cache
+    if frame_number == 0:
+        return video_pool.thumbnail(video_path)
+    return video_pool.read_frame(video_path, frame_number)
 
 
-def find_cluster_centers(mask):
-    # Label the clusters in the mask
-    labeled_mask, num_clusters = ndimage.label(mask)
+class FrameReader:
+    """
+    Stream frames of a video one at a time.
+
+    Frames are color converted (and optionally downscaled) into a single
+    output buffer that is reused between iterations, so peak memory does not
+    depend on the length of the video. Copy a yielded frame if it has to
+    outlive the next iteration, or pass copy=True.
+
+    :param video_path: Path to the video file.
+    :param color_code: cv2 color conversion code applied to every frame,
+                       None keeps the decoded BGR frames.
+    :param start: Index of the first frame to read.
+    :param stop: Index after the last frame to read, None reads to the end.
+    :param step: Yield every step-th frame.
+    :param max_size: If set, downscale frames so the longest side fits it.
+    :param copy: Yield a fresh array per frame instead of the shared buffer.
+    """
+    def __init__(self, video_path, color_code=cv2.COLOR_BGR2RGB, start=0,
+                 stop=None, step=1, max_size=None, copy=False):
+        if step < 1:
+            raise ValueError(f"step must be positive, got {step}")
+        self.video_path = video_path
+        self.color_code = color_code
+        self.start = start
+        self.stop = stop
+        self.step = step
+        self.max_size = max_size
+        self.copy = copy
+        self.capture = None
+        self._resized = None
+        self._output = None
+
+    def open(self):
+        if self.capture is None:
+            self.capture = cv2.VideoCapture(self.video_path)
+            if self.start:
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, self.start)
+        return self
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+        self._resized = None
+        self._output = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _target_size(self, frame):
+        height, width = frame.shape[:2]
+        if not self.max_size or max(height, width) <= self.max_size:
+            return None
+        scale = self.max_size / max(height, width)
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    def _convert(self, frame):
+        target_size = self._target_size(frame)
+        if target_size is not None:
+            # Downscale before the color conversion so it runs on fewer pixels
+            if self._resized is None or self._resized.shape[1::-1] != target_size:
+                self._resized = np.empty((target_size[1], target_size[0], frame.shape[2]), frame.dtype)
+            frame = cv2.resize(frame, target_size, dst=self._resized, interpolation=cv2.INTER_AREA)
+        if self.color_code is None:
+            return frame.copy() if self.copy else frame
+        if self.copy:
+            return cv2.cvtColor(frame, self.color_code)
+        if self._output is None or self._output.shape[:2] != frame.shape[:2]:
+            self._output = cv2.cvtColor(frame, self.color_code)
+            return self._output
+        return cv2.cvtColor(frame, self.color_code, dst=self._output)
+
+    def __iter__(self):
+        self.open()
+        capture = self.capture
+        index = self.start
+        frame = None
+        while self.stop is None or index < self.stop:
+            if (index - self.start) % self.step:
+                # Skipped frames are only demuxed, never decoded into a buffer
+                if not capture.grab():
+                    break
+            else:
+                flag, frame = capture.read(frame)
+                if not flag:
+                    break
+                yield self._convert(frame)
+            index += 1
+
+
+def iter_frames(video_path, color_code=cv2.COLOR_BGR2RGB, start=0, stop=None,
+                step=1, max_size=None, copy=False):
+    """
+    Generator over the frames of a video, see FrameReader for the parameters.
+    The capture is released when the generator is exhausted or closed.
+    """
+    with FrameReader(video_path, color_code, start, stop, step, max_size, copy) as reader:
+        yield from reader
+
+
+def frame_extraction(video_path, start=0, stop=None, step=1, max_size=None):
+    return list(iter_frames(
+        video_path, cv2.COLOR_BGR2RGB, start, stop, step, max_size, copy=True
+    ))
 
-    # Find the center of each cluster
-    centers = ndimage.center_of_mass(mask, labeled_mask, range(1, num_clusters+1))
 
-    # Convert to tuples of integers
-    centers = [tuple(map(int, center)) for center in centers]
+def frame_extraction_rgba(video_path, start=0, stop=None, step=1, max_size=None):
+    return list(iter_frames(
+        video_path, cv2.COLOR_BGR2RGBA, start, stop, step, max_size, copy=True
+    ))
 
-    centers = [center[::-1] for center in centers]
 
-    return centers
+def find_cluster_centers(mask):
+    # Centroids of the 4-connected clusters, as (x, y) integer tuples
+    components = analyze_components(mask, connectivity=4)
+    return [(int(x), int(y)) for x, y in components.centroids]
 
 
 def delete_border(logo):
@@ -177,10 +363,7 @@ def resize_image(image, max_size):
 
 
 def get_video_length(video_path):
-    video = cv2.VideoCapture(video_path)
-    length = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-    video.release()
-    return length
+    return video_pool.metadata(video_path).frame_count
 
 
 def convex_hull_mask(image, points):
@@ -213,28 +396,158 @@ def read_data_from_json(path):
     return data
 
 
-def change_fps(input_path: str, output_path: str, new_fps: int) -> None:    
-    cap = cv2.VideoCapture(input_path)
-    if not cap.isOpened():
-        print(f"Error: Could not open video file {input_path}")
-        return
-    
-    # Get video properties
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    
-    # Define codec and create VideoWriter object
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output_path, fourcc, new_fps, (width, height))
-    
-    # Read and write each frame
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        out.write(frame)
-    cap.release()
-    out.release()
+def change_fps(input_path: str, output_path: str, new_fps: int) -> None:
+    transcode_video(input_path, output_path, target_fps=new_fps)
+
+
+TranscodeStats = collections.namedtuple(
+    'TranscodeStats', ['frames_read', 'frames_written', 'seconds', 'fps']
+)
+
+_STAGE_END = object()
+
+
+class _QueueStage(threading.Thread):
+    """
+    Runs an iterable in its own thread and hands its items over through a
+    bounded queue, so consecutive pipeline stages overlap. Exceptions are
+    re-raised in the consuming thread.
+    """
+    def __init__(self, iterable, maxsize=8):
+        super().__init__(daemon=True)
+        self.iterable = iterable
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stopped = threading.Event()
+        self.error = None
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self):
+        try:
+            for item in self.iterable:
+                if not self._put(item):
+                    break
+        except BaseException as e:
+            self.error = e
+        finally:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+            self._put(_STAGE_END)
+
+    def __iter__(self):
+        self.start()
+        while True:
+            item = self.queue.get()
+            if item is _STAGE_END:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+    def stop(self):
+        self.stopped.set()
+
+
+def _decode_frames(input_path, stop):
+    with contextlib.closing(iter_frames(input_path, None, stop=stop, copy=True)) as frames:
+        yield from frames
+
+
+def _transform_frames(frames, ratio, max_size, blend):
+    """
+    Resample decoded frames in time and resize them. Output frame k sits at
+    source position k * ratio: 'nearest' mode drops or repeats frames, blend
+    mode mixes the two neighbouring frames by the fractional position.
+    """
+    target_size = None
+    written = 0
+    previous = None
+    index = -1
+    for index, frame in enumerate(frames):
+        if max_size:
+            if target_size is None:
+                height, width = frame.shape[:2]
+                scale = min(1.0, max_size / max(height, width))
+                target_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            if target_size != frame.shape[1::-1]:
+                frame = cv2.resize(frame, target_size, interpolation=cv2.INTER_AREA)
+        if not blend:
+            while written * ratio < index + 0.5:
+                yield frame
+                written += 1
+            continue
+        if previous is not None:
+            while written * ratio < index:
+                weight = written * ratio - (index - 1)
+                yield cv2.addWeighted(previous, 1.0 - weight, frame, weight, 0.0)
+                written += 1
+        previous = frame
+    if blend and previous is not None:
+        while written * ratio < index + 0.5:
+            yield previous
+            written += 1
+
+
+def _open_video_writer(output_path, codec, fps, size):
+    for fourcc in (codec, 'mp4v'):
+        writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+        if writer.isOpened():
+            return writer
+        print(f"Codec {fourcc} is not available, trying the next one")
+    raise RuntimeError(f"Could not open a video writer for {output_path}")
+
+
+def transcode_video(input_path, output_path, target_fps=None, max_size=None,
+                    max_duration=None, blend=False, codec='avc1', queue_size=8):
+    """
+    Re-encode a video in one streaming pass.
+
+    Decoding, transforming and encoding run in separate threads connected by
+    bounded queues, so decode and encode overlap while memory stays flat.
+    The video is resampled to target_fps by dropping or duplicating frames
+    (or blending neighbours with blend=True) so the duration is preserved,
+    and downscaled so the longest side fits max_size.
+
+    :param max_duration: If set, only the first max_duration seconds are kept.
+    :param codec: FourCC of the output, falls back to mp4v if unavailable.
+    :return: TranscodeStats with the processing speed in frames per second.
+    """
+    start = time.perf_counter()
+    metadata = video_pool.metadata(input_path)
+    source_fps = metadata.fps or target_fps or 30
+    output_fps = target_fps or source_fps
+    stop = int(max_duration * source_fps) if max_duration else None
+
+    decode = _QueueStage(_decode_frames(input_path, stop), queue_size)
+    transform = _QueueStage(
+        _transform_frames(decode, source_fps / output_fps, max_size, blend), queue_size
+    )
+    writer = None
+    written = 0
+    try:
+        for frame in transform:
+            if writer is None:
+                writer = _open_video_writer(output_path, codec, output_fps, frame.shape[1::-1])
+            writer.write(frame)
+            written += 1
+    finally:
+        transform.stop()
+        decode.stop()
+        if writer is not None:
+            writer.release()
+
+    seconds = time.perf_counter() - start
+    frames_read = min(metadata.frame_count, stop) if stop else metadata.frame_count
+    stats = TranscodeStats(frames_read, written, seconds, frames_read / seconds if seconds else 0.0)
+    print(f"Transcoded {input_path}: {frames_read} -> {written} frames in {seconds:.2f}s ({stats.fps:.1f} fps)")
+    return stats
 
 
 def add_grid(image, cells_count=30, color=(0, 0, 255)):
@@ -264,16 +577,7 @@ def get_video_fps(video_path: str) -> int:
     Returns:
     - float: The FPS of the video.
     """
-    # Initialize VideoCapture object
-    cap = cv2.VideoCapture(video_path)
-
-    # Get FPS
-    fps = cap.get(cv2.CAP_PROP_FPS)
-
-    # Release VideoCapture object
-    cap.release()
-
-    return int(fps)
+    return int(video_pool.metadata(video_path).fps)
 
 
 def append_underscore_to_video_name(video_path: str) -> str:
@@ -298,24 +602,81 @@ def map_points_to_original(points_array, canvas_size, original_size):
     return original_points
 
 
-def get_color_masks(masks, colors=color_palette):
-    colored_overlay = np.zeros((*masks[0].shape, 3), np.uint8)
-    for mask, color in zip(masks, colors):
-        # Ensure mask is binary
-        mask = (mask > 0).astype(np.uint8)
-        colored_overlay[mask > 0] = color  # Assign color to the masked region
+def masks_to_label_map(masks, out=None):
+    """
+    Collapse N binary masks into one uint8 label map in a single pass:
+    0 is background and i + 1 marks mask i. Where masks overlap the later
+    mask wins, like the assignment order of the old get_color_masks loop.
+    """
+    stacked = np.asarray(masks) > 0
+    # argmax over the reversed stack finds the last mask covering each pixel
+    last = np.argmax(stacked[::-1], axis=0)
+    covered = stacked.any(axis=0)
+    label_map = np.subtract(len(stacked), last, out=out, dtype=np.uint8, casting='unsafe')
+    label_map[~covered] = 0
+    return label_map
 
-    return colored_overlay
 
-def blend_frames_with_colored_masks(frames, colored_overlaies, alpha=0.5):
-    blended_frames = []
+def make_overlay_palette(colors=color_palette):
+    return np.vstack([np.zeros((1, 3), np.uint8), np.asarray(colors, dtype=np.uint8)])
+
 
-    for frame, colored_overlay in zip(frames, colored_overlaies):
-        blended = cv2.addWeighted(frame, 1.0, colored_overlay, alpha, 0.0)
+class MaskOverlayRenderer:
+    """
+    Render colored mask overlays and blend them onto frames.
+
+    Masks are turned into a label map and colored with one palette lookup,
+    and the blend is written into buffers that are reused between frames,
+    so the cost grows with the number of frames rather than frames x objects.
+    Returned arrays are overwritten by the next call, copy them to keep them.
 
-        blended_frames.append(blended)
+    :param colors: One color per object, background is always black.
+    :param alpha: Weight of the overlay added to the frame.
+    """
+    def __init__(self, colors=color_palette, alpha=0.5):
+        self.palette = make_overlay_palette(colors)
+        self.alpha = alpha
+        self.label_map = None
+        self.overlay = None
+        self.blended = None
+
+    def _buffers(self, shape):
+        if self.label_map is None or self.label_map.shape != shape:
+            self.label_map = np.empty(shape, np.uint8)
+            self.overlay = np.empty((*shape, 3), np.uint8)
+            self.blended = np.empty((*shape, 3), np.uint8)
+
+    def color_masks(self, masks):
+        # Masks beyond the number of colors are ignored, as zip() did before
+        masks = masks[:len(self.palette) - 1]
+        self._buffers(np.shape(masks[0]))
+        masks_to_label_map(masks, out=self.label_map)
+        np.take(self.palette, self.label_map, axis=0, out=self.overlay)
+        return self.overlay
+
+    def render(self, frame, masks):
+        overlay = self.color_masks(masks)
+        return cv2.addWeighted(frame, 1.0, overlay, self.alpha, 0.0, dst=self.blended)
+
+
+def iter_blended_frames(frames, masks_per_frame, alpha=0.5, colors=color_palette):
+    """
+    Lazily yield frames blended with their colored masks. The yielded array
+    is a shared buffer, see MaskOverlayRenderer.
+    """
+    renderer = MaskOverlayRenderer(colors, alpha)
+    for frame, masks in zip(frames, masks_per_frame):
+        yield renderer.render(frame, masks)
 
-    return blended_frames
+
+def get_color_masks(masks, colors=color_palette):
+    return MaskOverlayRenderer(colors).color_masks(masks).copy()
+
+def blend_frames_with_colored_masks(frames, colored_overlaies, alpha=0.5):
+    return [
+        cv2.addWeighted(frame, 1.0, colored_overlay, alpha, 0.0)
+        for frame, colored_overlay in zip(frames, colored_overlaies)
+    ]
 
 
 
@@ -349,16 +710,78 @@ def expand_bbox(rmin, cmin, rmax, cmax, n, img_shape):
     return rmin, cmin, rmax, cmax
 
 
-def extract_line_endpoints(binary_mask):
-    labeled_mask = label(binary_mask)
-    num_lines = labeled_mask.max()
+ComponentStats = collections.namedtuple(
+    'ComponentStats', ['labels', 'count', 'bboxes', 'areas', 'centroids', 'masks']
+)
 
-    line_masks = []
 
-    for i in range(1, num_lines + 1):
-        line_mask = labeled_mask == i
-        line_masks.append(line_mask)
+def analyze_components(mask, connectivity=8, with_masks=False):
+    """
+    Label the connected components of a binary mask in one pass.
+
+    :param connectivity: 8 for full connectivity (like skimage.measure.label),
+                         4 for edge neighbours only (like scipy.ndimage.label).
+    :param with_masks: Also return one cropped boolean mask per component.
+    :return: ComponentStats with
+             labels    - int32 label image, 0 is background, components are 1..count
+                         in raster order of their first pixel, as skimage and ndimage number them,
+             bboxes    - (count, 4) array of x, y, width, height,
+             areas     - (count,) pixel counts,
+             centroids - (count, 2) array of x, y,
+             masks     - list of (slices, cropped mask) per component, or None.
+    """
+    binary = (np.asarray(mask) > 0).astype(np.uint8)
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(
+        binary, connectivity=connectivity, ltype=cv2.CV_32S
+    )
+    count = num_labels - 1
+    if count > 1:
+        # cv2 does not number components in scan order, renumber them by their first pixel
+        tops = stats[1:, cv2.CC_STAT_TOP]
+        first_columns = [
+            left + int(np.argmax(labels[top, left:left + width] == i))
+            for i, (left, top, width) in enumerate(stats[1:, :3], start=1)
+        ]
+        order = np.lexsort((first_columns, tops))
+        if not np.array_equal(order, np.arange(count)):
+            new_labels = np.zeros(num_labels, dtype=np.int32)
+            new_labels[order + 1] = np.arange(1, num_labels, dtype=np.int32)
+            labels = new_labels[labels]
+            rows = np.concatenate(([0], order + 1))
+            stats, centroids = stats[rows], centroids[rows]
+    masks = None
+    if with_masks:
+        masks = [
+            (slices, labels[slices] == i)
+            for i, slices in enumerate(ndimage.find_objects(labels, max_label=count), start=1)
+        ]
+    return ComponentStats(
+        labels=labels,
+        count=count,
+        bboxes=stats[1:, :4],
+        areas=stats[1:, cv2.CC_STAT_AREA],
+        centroids=centroids[1:],
+        masks=masks,
+    )
+
+
+def extract_line_endpoints(binary_mask, cropped=False):
+    """
+    Split a mask into one mask per 8-connected component.
 
+    :param cropped: Return (slices, cropped mask) pairs instead of full-frame
+                    masks, which keeps memory proportional to the components.
+    """
+    components = analyze_components(binary_mask, connectivity=8, with_masks=True)
+    if cropped:
+        return components.masks
+
+    line_masks = []
+    for slices, component_mask in components.masks:
+        # np.zeros is lazily committed, only the pages under the component are touched
+        line_mask = np.zeros(components.labels.shape, dtype=bool)
+        line_mask[slices] = component_mask
+        line_masks.append(line_mask)
     return line_masks
 
 
@@ -375,13 +798,17 @@ def read_servers_from_file(file_path):
     return ip_adresses
 
 
+@functools.lru_cache(maxsize=None)
+def get_apns_client(key_path='key.pem', use_sandbox=False):
+    # One long-lived HTTP/2 connection per key instead of one per notification
+    return APNsClient(key_path, use_sandbox=use_sandbox, use_alternative_port=False)
+
+
 def send_notification_to_popup(token_hex, message):
+    """
+    Send one notification synchronously. Request handlers should enqueue on
+    a NotificationService instead, which batches and never blocks on APNs.
+    """
     payload = Payload(alert=message, sound="default", badge=1)
     topic = 'com.example.App'
-    client = APNsClient('key.pem', use_sandbox=False, use_alternative_port=False)
-    client.send_notification(token_hex, payload, topic)
-
-    # To send multiple notifications in a batch
-    Notification = collections.namedtuple('Notification', ['token', 'payload'])
-    notifications = [Notification(payload=payload, token=token_hex)]
-    client.send_notification_batch(notifications=notifications, topic=topic)
+    get_apns_client().send_notification(token_hex, payload, topic)
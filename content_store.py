@@ -0,0 +1,138 @@
+import os
+import fcntl
+import shutil
+import hashlib
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+
+from pymongo import ReturnDocument
+
+
+CHUNK_SIZE = 1 << 20
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentStore:
+    """
+    Content-addressed storage of uploaded videos.
+
+    Every distinct video is stored once under blob_storage/cas/<aa>/<sha256>
+    and hard-linked into the task folders that use it. The `blobs` collection
+    keeps a reference count per digest and task documents carry the digest in
+    `content_digest`. Removing a task folder only drops a link, release()
+    deletes the blob once no task references it any more.
+
+    :param task_db: TaskDatabase of the service.
+    :param blob_storage: Root directory of the task folders.
+    :param storage: Optional StorageAccounting, blobs are counted once when created and deleted.
+    """
+    def __init__(self, task_db, blob_storage, storage=None):
+        self.root = Path(blob_storage) / 'cas'
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.blobs = task_db.db['blobs']
+        self.storage = storage
+        if storage is not None:
+            storage.content_store = self
+
+    def blob_path(self, digest):
+        return self.root / digest[:2] / f'{digest}.mp4'
+
+    @contextmanager
+    def locked(self):
+        # Serializes add/release so a blob is never deleted while being linked
+        with open(self.root / '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def save_stream(self, stream, path, chunk_size=CHUNK_SIZE):
+        """
+        Write a stream to `path` while hashing it, so the upload is read once.
+        :return: (sha256 hex digest, size in bytes).
+        """
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, 'wb') as f:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size
+
+    def add(self, path, digest, user_id=None):
+        """
+        Take a freshly written file into the store and replace it with a hard
+        link to the stored copy. A duplicate of an existing blob is discarded.
+        :return: True if the content was already stored (deduplicated).
+        """
+        blob_path = self.blob_path(digest)
+        size = os.path.getsize(path)
+        with self.locked():
+            previous = self.blobs.find_one_and_update(
+                {"_id": digest},
+                {
+                    "$inc": {"refcount": 1},
+                    "$setOnInsert": {"size": size, "user_id": user_id, "created_at": datetime.now().isoformat()},
+                },
+                upsert=True,
+                return_document=ReturnDocument.BEFORE,
+            )
+            deduplicated = previous is not None and blob_path.exists()
+            if deduplicated:
+                os.remove(path)
+            else:
+                blob_path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(path, blob_path)
+                if previous is None and self.storage is not None:
+                    self.storage.add_usage(user_id, size)
+            self.link(blob_path, path)
+        return deduplicated
+
+    @staticmethod
+    def link(blob_path, path):
+        try:
+            os.link(blob_path, path)
+        except OSError:
+            # Blob storage spread over several file systems, fall back to a copy
+            shutil.copyfile(blob_path, path)
+
+    def add_file(self, path, user_id=None):
+        """
+        Hash an existing file (e.g. a finalized chunked upload) and take it into the store.
+        :return: (digest, deduplicated).
+        """
+        digest = hash_file(path)
+        return digest, self.add(path, digest, user_id)
+
+    def release(self, digest):
+        """
+        Drop one reference to a blob and delete it when none are left.
+        :return: Number of bytes freed.
+        """
+        with self.locked():
+            blob = self.blobs.find_one_and_update(
+                {"_id": digest}, {"$inc": {"refcount": -1}}, return_document=ReturnDocument.AFTER
+            )
+            if blob is None or blob['refcount'] > 0:
+                return 0
+            self.blobs.delete_one({"_id": digest, "refcount": {"$lte": 0}})
+            try:
+                os.remove(self.blob_path(digest))
+            except FileNotFoundError:
+                pass
+        if self.storage is not None:
+            self.storage.add_usage(blob.get('user_id'), -blob['size'])
+        return blob['size']
+
+    def has(self, digest):
+        return self.blobs.find_one({"_id": digest, "refcount": {"$gt": 0}}, {"_id": 1}) is not None
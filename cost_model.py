@@ -0,0 +1,264 @@
+import json
+import time
+import threading
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING
+
+from mongo_handler import TaskStatus
+from video_pool import video_pool
+
+
+def count_objects(objects):
+    if isinstance(objects, str):
+        try:
+            objects = json.loads(objects)
+        except ValueError:
+            return 0
+    return len(objects) if isinstance(objects, (dict, list)) else 0
+
+
+def cost_from_metadata(metadata, object_count):
+    """
+    Cost features of a task. `units` is the scalar the scheduler orders by:
+    megapixel-frames times (1 + objects), since every tracked object is
+    another pass over every frame.
+    :param metadata: Dictionary with frame_count, fps, width and height.
+    """
+    frame_count = metadata.get('frame_count') or 0
+    fps = metadata.get('fps') or 0
+    megapixels = (metadata.get('width') or 0) * (metadata.get('height') or 0) / 1e6
+    return {
+        'frame_count': frame_count,
+        'fps': fps,
+        'duration': frame_count / fps if fps else None,
+        'width': metadata.get('width'),
+        'height': metadata.get('height'),
+        'objects': object_count,
+        'units': frame_count * megapixels * (1 + object_count),
+    }
+
+
+def cost_features(video_path, objects):
+    """
+    Build the cost features of an uploaded video from the pooled metadata,
+    the same probe get_video_length and get_video_fps read.
+    """
+    return cost_from_metadata(video_pool.metadata(video_path)._asdict(), count_objects(objects))
+
+
+class LinearFit:
+    """
+    Exponentially weighted least squares of seconds = overhead + slope * units.
+    """
+    def __init__(self, decay):
+        self.decay = decay
+        self.n = self.sx = self.sy = self.sxx = self.sxy = 0.0
+        self.samples = 0
+
+    def add(self, x, y):
+        d = self.decay
+        self.n = d * self.n + 1
+        self.sx = d * self.sx + x
+        self.sy = d * self.sy + y
+        self.sxx = d * self.sxx + x * x
+        self.sxy = d * self.sxy + x * y
+        self.samples += 1
+
+    def params(self):
+        """
+        :return: (overhead seconds, seconds per unit).
+        """
+        variance = self.n * self.sxx - self.sx * self.sx
+        if variance > 1e-9 * max(self.n * self.sxx, 1e-12):
+            slope = (self.n * self.sxy - self.sx * self.sy) / variance
+            overhead = (self.sy - slope * self.sx) / self.n
+            if slope > 0 and overhead >= 0:
+                return overhead, slope
+        # Too little spread in the sizes seen so far, fall back to a pure rate
+        if self.sx > 0:
+            return 0.0, self.sy / self.sx
+        return self.sy / self.n, 0.0
+
+
+class ThroughputModel:
+    """
+    Per-worker processing time model learned from completed tasks.
+
+    Every done task with a claim time gives one sample (cost units, seconds
+    from in_progress to done) for the worker that ran it and for the fleet.
+    Each worker gets its own exponentially weighted linear fit; workers with
+    fewer than `min_samples` samples use the fleet fit. refresh() reads only
+    the tasks completed since the previous call, from the
+    (status, done_timestamp) index.
+
+    :param task_db: TaskDatabase of the service.
+    :param decay: Weight kept by older samples at each new one.
+    :param min_samples: Samples before a worker's own fit is trusted.
+    :param history: Done tasks read on the first refresh.
+    :param refresh_interval: Seconds between two refreshes in maybe_refresh.
+    """
+    def __init__(self, task_db, decay=0.98, min_samples=5, history=5000, refresh_interval=60.0):
+        self.task_db = task_db
+        self.decay = decay
+        self.min_samples = min_samples
+        self.history = history
+        self.refresh_interval = refresh_interval
+        self.workers = {}
+        self.fleet = LinearFit(decay)
+        self.last_done = None
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    def observe(self, worker, units, seconds):
+        with self.lock:
+            fit = self.workers.get(worker)
+            if fit is None:
+                fit = self.workers[worker] = LinearFit(self.decay)
+            fit.add(units, seconds)
+            self.fleet.add(units, seconds)
+
+    def refresh(self):
+        """
+        :return: Number of completed tasks learned from.
+        """
+        query = {"status": TaskStatus.DONE.state}
+        projection = {"_id": 0, "cost.units": 1, "claimed_at": 1, "done_timestamp": 1, "machine_ip": 1}
+        if self.last_done is None:
+            tasks = list(self.task_db.tasks.find(
+                query, projection, sort=[("done_timestamp", DESCENDING)], limit=self.history
+            ))[::-1]
+        else:
+            query["done_timestamp"] = {"$gt": self.last_done}
+            tasks = list(self.task_db.tasks.find(query, projection, sort=[("done_timestamp", ASCENDING)]))
+
+        learned = 0
+        for task in tasks:
+            self.last_done = task.get('done_timestamp') or self.last_done
+            units = (task.get('cost') or {}).get('units')
+            if units is None or not task.get('claimed_at') or not task.get('done_timestamp'):
+                continue
+            seconds = (
+                datetime.fromisoformat(task['done_timestamp']) - datetime.fromisoformat(task['claimed_at'])
+            ).total_seconds()
+            if seconds > 0:
+                self.observe(task.get('machine_ip'), units, seconds)
+                learned += 1
+        self.refreshed_at = time.monotonic()
+        return learned
+
+    def maybe_refresh(self):
+        if self.refreshed_at is not None and time.monotonic() - self.refreshed_at <= self.refresh_interval:
+            return
+        # Request threads share the model, one of them refreshes it
+        if not self.refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self.refresh()
+        finally:
+            self.refresh_lock.release()
+
+    def params(self, worker=None):
+        """
+        :return: (overhead seconds, seconds per unit) for the worker, or None before any sample.
+        """
+        with self.lock:
+            fit = self.workers.get(worker) if worker is not None else None
+            if fit is None or fit.samples < self.min_samples:
+                fit = self.fleet
+            if fit.samples == 0:
+                return None
+            return fit.params()
+
+    def predict(self, units, worker=None):
+        """
+        Expected processing seconds of a task of `units` cost units, None without data.
+        """
+        params = self.params(worker)
+        if params is None or units is None:
+            return None
+        overhead, slope = params
+        return overhead + slope * units
+
+    def known_workers(self):
+        with self.lock:
+            return [
+                worker for worker, fit in self.workers.items()
+                if worker is not None and fit.samples >= self.min_samples
+            ]
+
+    def queue_eta(self, count_ahead, units_ahead, units):
+        """
+        Seconds until a waiting task is done: the work queued before it spread
+        over the known workers, plus its own processing time.
+        """
+        params = self.params()
+        if params is None:
+            return None
+        overhead, slope = params
+        workers = max(len(self.known_workers()), 1)
+        ahead = (count_ahead * overhead + slope * units_ahead) / workers
+        return ahead + overhead + slope * (units or 0)
+
+
+class QueueOrder:
+    """
+    Position and cost units queued ahead of every waiting task, in the order
+    of the active scheduling policy.
+
+    The dispatcher publishes the order with the prefix sums of cost.units at
+    most every `publish_interval` seconds, as one document of the queue_order
+    collection. Readers keep the parsed document for `ttl` seconds, so a
+    status request is a dictionary lookup instead of a scan of the queue.
+    Tasks missing from the order (queued since, past the `horizon`, or in a
+    lower priority class than the ones selected) count as behind all of it.
+
+    :param task_db: TaskDatabase of the service.
+    :param horizon: Waiting tasks included in the published order.
+    :param publish_interval: Seconds between two publications in maybe_publish.
+    :param ttl: Seconds a reader keeps the order it read.
+    """
+    def __init__(self, task_db, horizon=10000, publish_interval=5.0, ttl=2.0):
+        self.collection = task_db.db['queue_order']
+        self.horizon = horizon
+        self.publish_interval = publish_interval
+        self.ttl = ttl
+        self.published_at = None
+        self.read_at = None
+        self.positions = {}
+        self.units_ahead = [0.0]
+        self.lock = threading.Lock()
+
+    def publish(self, tasks):
+        """
+        :param tasks: Waiting tasks in dispatch order, with their cost.
+        """
+        task_ids, units_ahead = [], [0.0]
+        for task in tasks:
+            task_ids.append(task['task_id'])
+            units_ahead.append(units_ahead[-1] + ((task.get('cost') or {}).get('units') or 0))
+        self.collection.replace_one(
+            {"_id": "waiting"},
+            {"task_ids": task_ids, "units_ahead": units_ahead, "computed_at": datetime.now().isoformat()},
+            upsert=True,
+        )
+        self.published_at = time.monotonic()
+
+    def maybe_publish(self, policy):
+        if self.published_at is not None and time.monotonic() - self.published_at <= self.publish_interval:
+            return
+        self.publish(policy.order(self.horizon, projection=['task_id', 'cost']))
+
+    def ahead(self, task_id):
+        """
+        :return: (waiting tasks dispatched before the task, their summed cost units).
+        """
+        with self.lock:
+            if self.read_at is None or time.monotonic() - self.read_at > self.ttl:
+                document = self.collection.find_one({"_id": "waiting"}) or {}
+                self.positions = {task_id: index for index, task_id in enumerate(document.get('task_ids', []))}
+                self.units_ahead = document.get('units_ahead') or [0.0]
+                self.read_at = time.monotonic()
+            position = self.positions.get(task_id, len(self.units_ahead) - 1)
+            return position, self.units_ahead[position]
@@ -1,35 +1,41 @@
 import argparse
-from datetime import datetime, timedelta
-import os
+import time
 from mongo_handler import TaskDatabase  # Ensure this import works for your project structure
+from retention import RetentionEngine
+from storage_quota import StorageAccounting, EVICTION_POLICIES
+from content_store import ContentStore
+from chunked_upload import ChunkedUploadStore
 
-# USE: 0 2 * * * /usr/bin/python3 /path/to/your_script.py
+# USE: */5 * * * * /usr/bin/python3 /path/to/your_script.py
+# or keep it running with --interval_minutes
 
 # Setup argparse
 parser = argparse.ArgumentParser(description="Delete videos stored for more than a specified number of days.")
 parser.add_argument('--db_url', default='mongodb://localhost:27017/', help='MongoDB connection URL.')
 parser.add_argument('--db_name', default='mydatabase', help='MongoDB database name.')
 parser.add_argument('--days', type=int, default=7, help='Number of days after which videos should be deleted.')
+parser.add_argument('--blob_storage_path', default='files/blob_storage', help='Path to the blob storage directory.')
+parser.add_argument('--batch_size', type=int, default=500, help='Tasks deleted per batch.')
+parser.add_argument('--max_batches', type=int, default=20, help='Upper bound of batches per run.')
+parser.add_argument('--delete_threads', type=int, default=4, help='Threads removing task directories.')
+parser.add_argument('--checkpoint_path', default='files/retention_checkpoint.json', help='Progress file kept between runs.')
+parser.add_argument('--interval_minutes', type=float, default=None, help='Run repeatedly with this pause instead of once.')
+parser.add_argument('--storage_high_water_gb', type=float, default=None, help='Also evict done results above this usage.')
+parser.add_argument('--eviction_policy', default='lru', choices=list(EVICTION_POLICIES), help='Order in which results are evicted.')
+parser.add_argument('--upload_max_age_hours', type=float, default=24, help='Remove chunked uploads not finalized after this many hours.')
 args = parser.parse_args()
 
-def delete_old_videos(database_host, database_port, database_name, days):
+def delete_old_videos(database_host, database_port, database_name, days, blob_storage_path='files/blob_storage'):
     task_db = TaskDatabase(
         db_host=database_host,
         db_port=database_port,
         db_name=database_name
     )
-    cutoff_date = datetime.now() - timedelta(days=days)
-    cutoff_timestamp = cutoff_date.isoformat()
-    old_tasks = task_db.done.find({"done_timestamp": {"$lt": cutoff_timestamp}})
-    for task in old_tasks:
-        file_path = task.get('file_path')
-        if file_path and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-                print(f"Deleted {file_path}")
-            except Exception as e:
-                print(f"Error deleting {file_path}: {e}")
-        task_db.done.delete_one({"_id": task["_id"]})
+    storage = StorageAccounting(task_db, blob_storage_path)
+    ContentStore(task_db, blob_storage_path, storage)
+    engine = RetentionEngine(task_db, blob_storage_path, days=days, storage=storage)
+    engine.ensure_indexes()
+    return engine.run_once()
 
 def delete_old_uuid(database_host, database_port, database_name, days):
     task_db = TaskDatabase(
@@ -41,4 +47,36 @@ def delete_old_uuid(database_host, database_port, database_name, days):
 
 
 if __name__ == "__main__":
-    delete_old_videos(args.db_url, args.db_name, args.days)
+    task_db = TaskDatabase(args.db_url, None, args.db_name)
+    storage = StorageAccounting(
+        task_db,
+        args.blob_storage_path,
+        high_water_bytes=args.storage_high_water_gb * 1e9 if args.storage_high_water_gb else None,
+        policy=args.eviction_policy,
+    )
+    # Attaches itself to storage, so deleted tasks release their input blobs
+    ContentStore(task_db, args.blob_storage_path, storage)
+    engine = RetentionEngine(
+        task_db,
+        args.blob_storage_path,
+        days=args.days,
+        batch_size=args.batch_size,
+        max_batches=args.max_batches,
+        delete_threads=args.delete_threads,
+        checkpoint_path=args.checkpoint_path,
+        storage=storage,
+    )
+    chunked_uploads = ChunkedUploadStore(
+        args.blob_storage_path, max_age=args.upload_max_age_hours * 3600, storage=storage
+    )
+    engine.ensure_indexes()
+    storage.ensure_indexes()
+    while True:
+        expired, released = chunked_uploads.expire()
+        if expired:
+            print(f"Removed {expired} abandoned uploads, released {released / 1e6:.1f} MB")
+        engine.run_once()
+        storage.evict()
+        if args.interval_minutes is None:
+            break
+        time.sleep(args.interval_minutes * 60)
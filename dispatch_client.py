@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import RollingStats
+
+
+CHUNK_SIZE = 1 << 20
+
+# Answers of a worker to a cached-input offer that mean the video has to be sent:
+# 409 is a cache miss, 400 a worker that does not know the protocol yet
+INPUT_MISS_STATUSES = (400, 409)
+
+
+class StreamingMultipartBody:
+    """
+    multipart/form-data body that reads the file part lazily in chunks.
+
+    requests builds `files=` uploads fully in memory; passing this object as
+    `data=` instead streams the video from disk. It exposes __len__ so requests
+    sends a Content-Length header rather than chunked transfer encoding.
+
+    :param fields: Mapping of plain form field names to string values.
+    :param file_field: Form field name of the file part.
+    :param file_path: Path of the file to stream.
+    """
+    def __init__(self, fields, file_field, file_path, chunk_size=CHUNK_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+
+        parts = []
+        for name, value in fields.items():
+            parts.append(
+                f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f'{value}\r\n'
+            )
+        parts.append(
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{file_field}"; '
+            f'filename="{os.path.basename(file_path)}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        )
+        self.head = ''.join(parts).encode('utf-8')
+        self.tail = f'\r\n--{self.boundary}--\r\n'.encode('utf-8')
+        self.file_size = os.path.getsize(file_path)
+
+    def __len__(self):
+        return len(self.head) + self.file_size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        with open(self.file_path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        yield self.tail
+
+
+class DispatchClient:
+    """
+    Sends tasks to workers over one pooled keep-alive requests.Session per host.
+
+    Parsed task configs are cached by (path, mtime), and the upload throughput
+    of every worker is tracked in a RollingStats in MB/s.
+
+    With `offer_cached_input`, dispatch is two-phase: the task metadata and
+    the video's content digest are posted first without the file, and the
+    video is streamed only if the worker answers that it does not hold it.
+
+    :param timeout: (connect, read) timeout of a dispatch request.
+    :param max_cached_configs: Number of serialized configs kept in memory.
+    :param offer_cached_input: Ask workers for a cached copy of the input before uploading it.
+    """
+    def __init__(self, timeout=(5, 600), pool_maxsize=4, max_cached_configs=256, offer_cached_input=True):
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.max_cached_configs = max_cached_configs
+        self.offer_cached_input = offer_cached_input
+        self.sessions = {}
+        self.configs = OrderedDict()
+        self.throughput = {}
+        self.lock = threading.Lock()
+        self.input_hits = 0
+        self.input_misses = 0
+        self.bytes_saved = 0
+
+    def session_for(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[host] = session
+            return session
+
+    def load_config(self, config_path):
+        """
+        Return the config file re-serialized as compact JSON, cached by mtime.
+        """
+        key = (config_path, os.stat(config_path).st_mtime_ns)
+        with self.lock:
+            config = self.configs.get(key)
+            if config is not None:
+                self.configs.move_to_end(key)
+                return config
+        with open(config_path, 'r') as f:
+            config = json.dumps(json.load(f))
+        with self.lock:
+            self.configs[key] = config
+            while len(self.configs) > self.max_cached_configs:
+                self.configs.popitem(last=False)
+        return config
+
+    def worker_throughput(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            stats = self.throughput.get(host)
+            if stats is None:
+                stats = RollingStats(f'upload throughput {host}', unit='MB/s', window=200)
+                self.throughput[host] = stats
+            return stats
+
+    def post_file(self, url, fields, file_field, file_path):
+        body = StreamingMultipartBody(fields, file_field, file_path)
+        start = time.perf_counter()
+        response = self.session_for(url).post(
+            url, data=body, headers={'Content-Type': body.content_type}, timeout=self.timeout
+        )
+        elapsed = time.perf_counter() - start
+        if elapsed > 0:
+            self.worker_throughput(url).add(len(body) / elapsed / 1e6)
+        return response
+
+    def offer_input(self, url, fields, content_digest):
+        """
+        Phase one of a dispatch: post the task without the video.
+        :return: The worker response, or None if the worker does not hold the input.
+        """
+        response = self.session_for(url).post(
+            url, data={**fields, 'input_digest': content_digest}, timeout=self.timeout
+        )
+        if response.status_code in INPUT_MISS_STATUSES:
+            return None
+        return response
+
+    def input_cache_stats(self):
+        offers = self.input_hits + self.input_misses
+        hit_rate = self.input_hits / offers if offers else 0.0
+        return (f'input cache: {self.input_hits} hits, {self.input_misses} misses ({hit_rate:.0%}), '
+                f'{self.bytes_saved / 1e6:.1f} MB not sent')
+
+    def send_task(self, task, server_url, response_url):
+        """
+        Send a video processing request to the server. The video is only
+        uploaded if the worker does not already hold it by content digest.
+
+        :param task: A dictionary containing task details.
+        :param server_url: URL of the video processing server.
+        :param response_url: URL to send the processed video to.
+        :return: The worker response, with `input_cached` set to whether the upload was skipped.
+        """
+        config_data = json.dumps({
+            'objects': json.dumps(task['objects']),
+            'animate_config': self.load_config(task['config_path']),
+            'response_url': response_url,
+            'task_id': task['task_id'],
+            # Lets the worker key its local input cache by content
+            'content_digest': task.get('content_digest'),
+        })
+        fields = {'config': config_data, 'response_url': response_url}
+        content_digest = task.get('content_digest')
+        if self.offer_cached_input and content_digest:
+            response = self.offer_input(server_url, fields, content_digest)
+            if response is not None:
+                # Only a 200 means the worker took the task from its cache,
+                # a busy or failing worker refused it and the caller handles that
+                response.input_cached = response.status_code == 200
+                if response.input_cached:
+                    with self.lock:
+                        self.input_hits += 1
+                        self.bytes_saved += os.path.getsize(task['original_video_path'])
+                return response
+            with self.lock:
+                self.input_misses += 1
+        response = self.post_file(server_url, fields, 'video', task['original_video_path'])
+        response.input_cached = False
+        return response
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+default_client = DispatchClient()
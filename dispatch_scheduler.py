@@ -0,0 +1,188 @@
+import os
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from metrics import RollingStats
+from mongo_handler import DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS
+from scheduling_policy import FifoPolicy
+
+
+# A lease covers this many times the expected processing time, for workers without heartbeats
+LEASE_COST_FACTOR = 3
+
+
+class DispatchScheduler:
+    """
+    Matches waiting tasks to free worker slots, many per tick.
+
+    Each tick reads the free slots of the fleet from the WorkerRegistry, asks
+    the scheduling policy for as many waiting tasks, assigns them in that
+    order (a task goes to a worker holding its input when one has a slot,
+    otherwise to the one the ThroughputModel expects to finish it first) and
+    claims every assignment with an atomic claim_task, so a task is sent
+    exactly once even with several dispatchers. The sends run in a bounded
+    thread pool; a task the worker refuses is released back to the queue,
+    or marked failed once it has been claimed max_attempts times.
+
+    :param task_db: TaskDatabase of the service.
+    :param registry: WorkerRegistry of the fleet.
+    :param client: DispatchClient used to send the tasks.
+    :param process_api_method: Name of the worker processing endpoint.
+    :param response_url: URL the workers post results to.
+    :param max_concurrency: Upper bound of dispatch requests in flight.
+    :param metrics_every: Print dispatch stats every this many dispatched tasks.
+    :param policy: Scheduling policy choosing the tasks, FifoPolicy by default.
+    :param model: Optional ThroughputModel, refreshed every tick and used to pick the fastest worker.
+    :param queue_order: Optional QueueOrder, the policy order of the queue is published to it for ETAs.
+    :param max_attempts: A task claimed this many times is failed instead of re-queued.
+    """
+    def __init__(
+            self,
+            task_db,
+            registry,
+            client,
+            process_api_method,
+            response_url,
+            max_concurrency=8,
+            metrics_every=20,
+            policy=None,
+            model=None,
+            queue_order=None,
+            max_attempts=DEFAULT_MAX_ATTEMPTS,
+        ):
+        self.task_db = task_db
+        self.registry = registry
+        self.client = client
+        self.process_api_method = process_api_method
+        self.response_url = response_url
+        self.max_concurrency = max_concurrency
+        self.metrics_every = metrics_every
+        self.policy = policy if policy is not None else FifoPolicy(task_db)
+        self.model = model
+        self.queue_order = queue_order
+        self.max_attempts = max_attempts
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.dispatch_latency = RollingStats('enqueue-to-dispatch latency')
+
+    def candidates(self, limit):
+        return self.policy.select(limit, projection=['task_id', 'timestamp', 'content_digest', 'cost'])
+
+    def assign(self, tasks, slots):
+        """
+        Pair tasks with workers in queue order, preferring workers that hold the input.
+        :param slots: address -> free slots, consumed by the assignment.
+        :return: List of (task, address).
+        """
+        assignments = []
+        for task in tasks:
+            addresses = [address for address, free in slots.items() if free > 0]
+            if not addresses:
+                break
+            units = (task.get('cost') or {}).get('units')
+            if self.model is not None and units is not None:
+                # Fastest expected worker first, for a worker with the input cached to override
+                addresses.sort(key=lambda address: self.model.predict(units, address) or 0)
+            address = self.registry.pick_worker(addresses, task.get('content_digest'))
+            slots[address] -= 1
+            assignments.append((task, address))
+        return assignments
+
+    def lease_seconds(self, task, address):
+        units = (task.get('cost') or {}).get('units')
+        expected = self.model.predict(units, address) if self.model is not None else None
+        return max(DEFAULT_LEASE_SECONDS, LEASE_COST_FACTOR * expected) if expected else DEFAULT_LEASE_SECONDS
+
+    def tick(self):
+        """
+        Dispatch as many waiting tasks as there are free slots and pool capacity.
+        :return: Number of tasks claimed and submitted.
+        """
+        if self.model is not None:
+            self.model.maybe_refresh()
+        if self.queue_order is not None:
+            self.queue_order.maybe_publish(self.policy)
+        slots = self.registry.free_slots()
+        with self.lock:
+            capacity = self.max_concurrency - self.in_flight
+        limit = min(sum(slots.values()), capacity)
+        if limit <= 0:
+            return 0
+
+        submitted = 0
+        for candidate, address in self.assign(self.candidates(limit), slots):
+            # Exactly once: only the dispatcher whose claim succeeds sends the task
+            task = self.task_db.claim_task(candidate['task_id'], address, self.lease_seconds(candidate, address))
+            if task is None:
+                continue
+            self.registry.acquire_slot(address)
+            with self.lock:
+                self.in_flight += 1
+            self.executor.submit(self.dispatch, task, address)
+            submitted += 1
+        return submitted
+
+    def dispatch(self, task, address):
+        url = self.registry.worker_url(address)
+        accepted = False
+        # Only an answer or a connection error from the worker takes it out of rotation,
+        # not a local error raised before the request went out
+        worker_refused = False
+        error = None
+        try:
+            print(f"Sending task {task['task_id']} to {url} for {self.process_api_method}")
+            response = self.client.send_task(task, os.path.join(url, self.process_api_method), self.response_url)
+            accepted = response.status_code == 200
+            if accepted:
+                self.on_accepted(task, address, url, response)
+            else:
+                worker_refused = True
+                error = f'Worker {address} answered {response.status_code}'
+                print(f"Failed to start task {task['task_id']} on {url}: {response.status_code}")
+        except requests.RequestException as e:
+            worker_refused = not accepted
+            error = f'Worker {address} unreachable: {e}'
+            print(f"Failed to send task {task['task_id']} to {url}: {e}")
+        except Exception as e:
+            error = f'Dispatch error: {e}'
+            print(f"Failed to send task {task['task_id']} to {url}: {e}")
+        finally:
+            try:
+                if not accepted:
+                    self.task_db.release_task(task['task_id'], max_attempts=self.max_attempts, error=error)
+            except Exception as e:
+                # The lease expires and requeue_expired_tasks puts the task back
+                print(f"Failed to release task {task['task_id']}: {e}")
+            finally:
+                try:
+                    self.registry.finish_dispatch(address, accepted)
+                    if worker_refused:
+                        # Busy (503) or failing, the worker gets no more tasks until the next probe
+                        self.registry.mark_busy(address)
+                finally:
+                    with self.lock:
+                        self.in_flight -= 1
+
+    def on_accepted(self, task, address, url, response):
+        print(f"Task {task['task_id']} is being processed"
+              f"{' from the cached input' if response.input_cached else ''}.")
+        self.registry.record_input(address, task.get('content_digest'))
+        # From when the task last became dispatchable, not from the upload:
+        # ingest time and earlier attempts are not dispatch latency
+        queued_at = task.get('queued_at') or task['timestamp']
+        with self.lock:
+            self.dispatch_latency.add(
+                (datetime.now() - datetime.fromisoformat(queued_at)).total_seconds()
+            )
+            report = self.dispatch_latency.total_count % self.metrics_every == 0
+        if report:
+            print(self.dispatch_latency)
+            print(self.client.worker_throughput(url))
+            print(self.client.input_cache_stats())
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
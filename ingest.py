@@ -0,0 +1,151 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from mongo_handler import TaskStatus
+from common import transcode_video
+from video_pool import video_pool
+from cost_model import cost_from_metadata, count_objects
+
+
+def probe_video(video_path):
+    metadata = video_pool.metadata(video_path)
+    return {
+        'frame_count': metadata.frame_count,
+        'fps': metadata.fps,
+        'width': metadata.width,
+        'height': metadata.height,
+        'codec': metadata.codec,
+        'duration': metadata.frame_count / metadata.fps if metadata.fps else None,
+        'size_bytes': os.path.getsize(video_path),
+    }
+
+
+def needs_normalization(metadata, target_fps=None, max_side=None, max_duration=None):
+    reasons = []
+    if target_fps and metadata['fps'] and metadata['fps'] > target_fps + 0.5:
+        reasons.append('fps')
+    if max_side and max(metadata['width'], metadata['height']) > max_side:
+        reasons.append('resolution')
+    if max_duration and metadata['duration'] and metadata['duration'] > max_duration:
+        reasons.append('duration')
+    return reasons
+
+
+def ingest_video(video_path, target_fps=None, max_side=None, max_duration=None):
+    """
+    Probe an uploaded video and, if it exceeds the limits, transcode it in
+    place (through a temporary file). Runs in a worker process of the pool.
+    :return: Ingest info stored on the task document.
+    """
+    start = time.perf_counter()
+    original = probe_video(video_path)
+    reasons = needs_normalization(original, target_fps, max_side, max_duration)
+    info = {'original': original, 'normalized': bool(reasons), 'reasons': reasons}
+    if reasons:
+        root, extension = os.path.splitext(video_path)
+        tmp_path = f'{root}.ingest{extension}'
+        stats = transcode_video(
+            video_path, tmp_path,
+            target_fps=target_fps if 'fps' in reasons else None,
+            max_size=max_side if 'resolution' in reasons else None,
+            max_duration=max_duration if 'duration' in reasons else None,
+        )
+        os.replace(tmp_path, video_path)
+        info['transcode'] = stats._asdict()
+    info['video_metadata'] = probe_video(video_path)
+    info['seconds'] = time.perf_counter() - start
+    return info
+
+
+class IngestPipeline:
+    """
+    Background ingest stage between upload and dispatch.
+
+    Uploaded tasks are inserted as INGESTING. A process pool probes each video,
+    normalizes it to the target fps / max side / max duration when needed and
+    the task becomes WAITING once its ingest info is recorded. A failed ingest
+    still releases the task, with the error recorded, so no upload gets stuck.
+
+    :param task_db: TaskDatabase used to record the results.
+    :param max_workers: Size of the process pool.
+    :param target_fps: Clips above this frame rate are resampled down to it.
+    :param max_side: Clips whose longest side exceeds this are downscaled.
+    :param max_duration: Clips longer than this many seconds are trimmed.
+    :param storage: Optional StorageAccounting updated with the normalized size.
+    :param content_store: Optional ContentStore, a normalized video replaces the uploaded blob.
+    """
+    def __init__(self, task_db, max_workers=2, target_fps=None, max_side=None, max_duration=None,
+                 storage=None, content_store=None):
+        self.task_db = task_db
+        self.storage = storage
+        self.content_store = content_store
+        self.target_fps = target_fps
+        self.max_side = max_side
+        self.max_duration = max_duration
+        # Spawned, not forked: the server process holds threads, locks and Mongo connections
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, task_id, video_path):
+        future = self.executor.submit(
+            ingest_video, video_path, self.target_fps, self.max_side, self.max_duration
+        )
+        future.add_done_callback(lambda f: self.on_done(task_id, f, video_path))
+        return future
+
+    def replace_content(self, task_id, video_path):
+        """
+        Store the normalized video in the ContentStore and drop the task's
+        reference to the uploaded one, so the digest matches what is dispatched.
+        :return: The new digest.
+        """
+        task = self.task_db.tasks.find_one({"task_id": task_id}, {"content_digest": 1, "user_id": 1}) or {}
+        digest, _ = self.content_store.add_file(video_path, task.get('user_id'))
+        if task.get('content_digest'):
+            self.content_store.release(task['content_digest'])
+        return digest
+
+    def on_done(self, task_id, future, video_path):
+        # Runs on the executor's management thread, an exception here would only be swallowed
+        try:
+            self.record_ingest(task_id, future, video_path)
+        except Exception as e:
+            print(f"Recording the ingest of task {task_id} failed, dispatching it unchanged: {e}")
+            try:
+                self.task_db.complete_ingest(task_id, {'normalized': False, 'error': str(e)})
+            except Exception as e:
+                print(f"Failed to release task {task_id} from ingest: {e}")
+
+    def record_ingest(self, task_id, future, video_path):
+        try:
+            info = future.result()
+        except Exception as e:
+            print(f"Ingest of task {task_id} failed, dispatching it unchanged: {e}")
+            info = {'normalized': False, 'error': str(e)}
+        content_digest, cost = None, None
+        if 'video_metadata' in info:
+            # Cost features come from the probe of the video that will be dispatched
+            task = self.task_db.tasks.find_one({"task_id": task_id}, {"objects_json": 1}) or {}
+            cost = cost_from_metadata(info['video_metadata'], count_objects(task.get('objects_json')))
+        if info.get('normalized') and self.content_store is not None:
+            content_digest = self.replace_content(task_id, video_path)
+        elif info.get('normalized') and self.storage is not None:
+            self.storage.record_size(task_id, 'upload_bytes', info['video_metadata']['size_bytes'])
+        self.task_db.complete_ingest(task_id, info, content_digest, cost)
+        if info.get('normalized'):
+            original, current = info['original'], info['video_metadata']
+            print(f"Ingested task {task_id}: {info['reasons']}, "
+                  f"{original['size_bytes']} -> {current['size_bytes']} bytes in {info['seconds']:.1f}s")
+
+    def resume_pending(self):
+        """
+        Resubmit tasks left in INGESTING, e.g. after a restart.
+        """
+        tasks = self.task_db.retrieve_all_tasks(TaskStatus.INGESTING.state)
+        for task in tasks:
+            self.submit(task['task_id'], task['original_video_path'])
+        return len(tasks)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,50 @@
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class RollingStats:
+    """
+    Thread-safe rolling window of numeric samples (latencies, throughputs)
+    with a percentile summary for periodic logging.
+
+    :param name: Name used in the printed summary.
+    :param unit: Unit suffix used in the printed summary.
+    :param window: Number of most recent samples kept.
+    """
+    def __init__(self, name, unit='s', window=1000):
+        self.name = name
+        self.unit = unit
+        self.samples = deque(maxlen=window)
+        self.total_count = 0
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        with self.lock:
+            self.samples.append(value)
+            self.total_count += 1
+
+    def summary(self):
+        with self.lock:
+            samples = np.array(self.samples, dtype=np.float64)
+            total_count = self.total_count
+        if not len(samples):
+            return {'count': total_count}
+        return {
+            'count': total_count,
+            'mean': float(samples.mean()),
+            'p50': float(np.percentile(samples, 50)),
+            'p99': float(np.percentile(samples, 99)),
+            'max': float(samples.max()),
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        if 'mean' not in summary:
+            return f"{self.name}: no samples"
+        return (
+            f"{self.name}: count={summary['count']} mean={summary['mean']:.3f}{self.unit} "
+            f"p50={summary['p50']:.3f}{self.unit} p99={summary['p99']:.3f}{self.unit} "
+            f"max={summary['max']:.3f}{self.unit}"
+        )
@@ -1,23 +1,45 @@
-from pymongo import MongoClient
-from copy import deepcopy
+from pymongo import MongoClient, ASCENDING, ReturnDocument
 import uuid
 from datetime import datetime
 import json
 from enum import Enum
 from datetime import datetime, timedelta
 
+from task_events import TaskNotifier, TaskStatusBroadcaster
+from ttl_cache import TTLCache, MISSING
+
 
 def parse_task(task_org):
-    task = deepcopy(task_org)
-    task['objects'] = json.loads(task['objects_json'])
-    del task['objects_json']
+    # Documents from pymongo are fresh dicts, a shallow copy keeps task_org intact
+    task = dict(task_org)
+    if 'objects_json' in task:
+        task['objects'] = json.loads(task.pop('objects_json'))
     return task
 
 
 class TaskStatus(Enum):
+    INGESTING = 'ingesting_tasks'
     WAITING = 'waiting_tasks'
     IN_PROGRESS = 'in_progress_tasks'
     DONE = 'done_tasks'
+    FAILED = 'failed_tasks'
+
+    @property
+    def state(self):
+        """Value of the `status` field of task documents in the tasks collection."""
+        return self.value[:-len('_tasks')]
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(f'{state}_tasks')
+
+
+TASK_STATES = tuple(status.state for status in TaskStatus)
+DEFAULT_LEASE_SECONDS = 3600
+DEFAULT_MAX_ATTEMPTS = 5
+USER_CACHE_TTL = 60
+USER_CACHE_NEGATIVE_TTL = 5
+RESULT_PATH_CACHE_TTL = 3600
 
 
 class TaskDatabase:
@@ -31,16 +53,52 @@ class TaskDatabase:
         """
         self.client = MongoClient(host=db_host, port=db_port,connect=False)
         self.db = self.client[db_name]
+        # Legacy per-status collections, only read by migrate_legacy_collections
         self.collections = {
             TaskStatus.WAITING: self.db[TaskStatus.WAITING.value],
             TaskStatus.IN_PROGRESS: self.db[TaskStatus.IN_PROGRESS.value],
             TaskStatus.DONE: self.db[TaskStatus.DONE.value]
         }
-        self.waiting = self.db[TaskStatus.WAITING.value]
-        self.in_progress = self.db[TaskStatus.IN_PROGRESS.value]
-        self.done = self.db[TaskStatus.DONE.value]
+        self.tasks = self.db['tasks']
         self.user_db = self.db['user_db']
+        # Woken whenever a task becomes dispatchable in this process
+        self.notifier = TaskNotifier()
+        # Woken whenever the status of a task changes in this process
+        self.status_events = TaskStatusBroadcaster()
+        # uuid -> user document, or None for tokens that do not exist
+        self.user_cache = TTLCache(maxsize=10000, ttl=USER_CACHE_TTL)
+        # task_id -> result file path, only for done tasks since those no longer change
+        self.result_path_cache = TTLCache(maxsize=10000, ttl=RESULT_PATH_CACHE_TTL)
+
+
+    def ensure_indexes(self):
+        """
+        Create the indexes the task queue relies on. Called once at service startup
+        rather than in __init__, so constructing the client stays fork-safe.
+        """
+        self.tasks.create_index([("task_id", ASCENDING)], unique=True)
+        self.tasks.create_index([("status", ASCENDING), ("timestamp", ASCENDING), ("task_id", ASCENDING)])
+        self.tasks.create_index([("status", ASCENDING), ("lease_expires_at", ASCENDING)])
+        self.tasks.create_index([("status", ASCENDING), ("done_timestamp", ASCENDING)])
+        self.user_db.create_index([("uuid", ASCENDING)])
 
+    def migrate_legacy_collections(self):
+        """
+        Move documents from the old waiting/in_progress/done collections into
+        the tasks collection, setting their status field.
+        :return: The number of migrated tasks.
+        """
+        migrated = 0
+        for status, collection in self.collections.items():
+            for task in collection.find():
+                task.pop('_id', None)
+                task['status'] = status.state
+                self.tasks.update_one(
+                    {"task_id": task['task_id']}, {"$setOnInsert": task}, upsert=True
+                )
+                collection.delete_one({"task_id": task['task_id']})
+                migrated += 1
+        return migrated
 
     def get_collection(self, status: TaskStatus):
         return self.collections[status]
@@ -51,18 +109,42 @@ class TaskDatabase:
             "created_at": datetime.now().isoformat(),
         }
         self.user_db.insert_one(document)
+        # Drop a cached negative lookup for this token
+        self.user_cache.invalidate(uuid4)
 
     def store_push_token(self, uuid4, push_token):
         pass
 
+    def remove_push_token(self, push_token):
+        """
+        Forget an APNs token that APNs rejected, for every user holding it.
+        """
+        users = list(self.user_db.find({"apns_token": push_token}, {"uuid": 1}))
+        self.user_db.update_many({"apns_token": push_token}, {"$unset": {"apns_token": ""}})
+        for user in users:
+            self.user_cache.invalidate(user.get("uuid"))
+
+
+    def get_user(self, uuid):
+        """
+        Return the user document for a token, served from the TTL cache.
+        Unknown tokens are cached too, for a shorter time.
+        """
+        document = self.user_cache.get(uuid)
+        if document is MISSING:
+            document = self.user_db.find_one({"uuid": uuid}, {"_id": 0})
+            ttl = USER_CACHE_TTL if document else USER_CACHE_NEGATIVE_TTL
+            self.user_cache.set(uuid, document, ttl=ttl)
+        return document
+
 
     def uuid_exists(self, uuid):
-        return self.user_db.find_one({"uuid": uuid}) is not None
+        return self.get_user(uuid) is not None
 
 
     def get_user_db_property(self, user_id, property_name):
-        document = self.user_db.find_one({"uuid": user_id})
-        return document[property_name] if document else None
+        document = self.get_user(user_id)
+        return document.get(property_name) if document else None
 
 
     def insert_task(
@@ -73,12 +155,23 @@ class TaskDatabase:
             config_path,
             task_id=None,
             file_path='',
-            task_type='video'
+            task_type='video',
+            status=TaskStatus.WAITING,
+            content_digest=None,
+            priority=0,
+            cost=None,
+            deadline=None,
         ):
         """
-        Insert a new task into the waiting collection.
+        Insert a new task into the waiting collection. queued_at records when
+        the task last became WAITING, timestamp keeps the upload time.
         :param objects: A dictionary of objects with keys like 'Object_1'.
         :param file_path: The file path to the result.
+        :param status: TaskStatus.INGESTING holds the task back until complete_ingest.
+        :param content_digest: SHA-256 of the input video in the ContentStore.
+        :param priority: Scheduling class, higher is dispatched first by FairSharePolicy.
+        :param cost: Cost features of the video, see cost_model.cost_features.
+        :param deadline: ISO timestamp the result is wanted by, used by DeadlinePolicy.
         :return: The unique task ID.
         """
         if task_id is None:
@@ -91,6 +184,7 @@ class TaskDatabase:
 
         task_document = {
             "task_id": task_id,
+            "status": status.state,
             "timestamp": current_timestamp,
             "objects_json": objects_json,
             "original_video_path": original_video_path,
@@ -98,40 +192,216 @@ class TaskDatabase:
             "file_path": file_path,
             "task_type": task_type,
             "user_id": user_id,
+            "priority": priority,
         }
-        self.waiting.insert_one(task_document)
+        if content_digest is not None:
+            task_document["content_digest"] = content_digest
+        if cost is not None:
+            task_document["cost"] = cost
+        if deadline is not None:
+            task_document["deadline"] = deadline
+        if status == TaskStatus.WAITING:
+            task_document["queued_at"] = current_timestamp
+        self.tasks.insert_one(task_document)
+        if status == TaskStatus.WAITING:
+            self.notifier.notify()
         return task_id
 
+    def complete_ingest(self, task_id, ingest_info, content_digest=None, cost=None):
+        """
+        Record the ingest results on a task and make it dispatchable.
+        :param ingest_info: Probe metadata and what the ingest stage did to the video.
+        :param content_digest: New digest of the input video if the ingest stage rewrote it.
+        :param cost: Cost features of the input video, from the ingest probe.
+        :return: True if the task was waiting for ingest.
+        """
+        update = {"status": TaskStatus.WAITING.state, "queued_at": datetime.now().isoformat(), "ingest": ingest_info}
+        if content_digest is not None:
+            update["content_digest"] = content_digest
+        if cost is not None:
+            update["cost"] = cost
+        result = self.tasks.update_one(
+            {"task_id": task_id, "status": TaskStatus.INGESTING.state},
+            {"$set": update},
+        )
+        if result.modified_count:
+            self.notifier.notify()
+            self.status_events.publish(task_id)
+        return result.modified_count > 0
+
+    def _claim_update(self, worker_id, lease_seconds):
+        now = datetime.now()
+        return {
+            "$set": {
+                "status": TaskStatus.IN_PROGRESS.state,
+                "machine_ip": worker_id,
+                "claimed_at": now.isoformat(),
+                "lease_expires_at": (now + timedelta(seconds=lease_seconds)).isoformat(),
+            },
+            "$inc": {"attempts": 1},
+        }
+
+    def claim_next_task(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Atomically take the oldest waiting task and mark it in progress.
+        Two dispatchers can never claim the same task, and the task is never
+        absent from the database between the two states.
+        :param worker_id: Identifier (IP address) of the worker the task goes to.
+        :param lease_seconds: After this many seconds without completion the task
+                              can be re-queued by requeue_expired_tasks.
+        :return: The parsed task or None if the queue is empty.
+        """
+        task = self.tasks.find_one_and_update(
+            {"status": TaskStatus.WAITING.state},
+            self._claim_update(worker_id, lease_seconds),
+            sort=[("timestamp", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if not task:
+            return None
+        self.status_events.publish(task['task_id'])
+        return parse_task(task)
+
+    def claim_task(self, task_id, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Atomically claim a specific waiting task.
+        :return: The parsed task or None if it is no longer waiting.
+        """
+        task = self.tasks.find_one_and_update(
+            {"task_id": task_id, "status": TaskStatus.WAITING.state},
+            self._claim_update(worker_id, lease_seconds),
+            return_document=ReturnDocument.AFTER,
+        )
+        if not task:
+            return None
+        self.status_events.publish(task_id)
+        return parse_task(task)
+
+    def renew_leases(self, task_ids, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Extend the leases of in-progress tasks held by worker_id, e.g. the
+        tasks a worker reports as running. Never shortens a lease.
+        :return: The number of extended leases.
+        """
+        lease_expires_at = (datetime.now() + timedelta(seconds=lease_seconds)).isoformat()
+        result = self.tasks.update_many(
+            {
+                "task_id": {"$in": list(task_ids)},
+                "status": TaskStatus.IN_PROGRESS.state,
+                "machine_ip": worker_id,
+                "lease_expires_at": {"$lt": lease_expires_at},
+            },
+            {"$set": {"lease_expires_at": lease_expires_at}},
+        )
+        return result.modified_count
+
+    @staticmethod
+    def _fail_update(error):
+        now = datetime.now().isoformat()
+        # done_timestamp lets retention delete failed tasks like done ones
+        return {
+            "$set": {"status": TaskStatus.FAILED.state, "error": error, "failed_at": now, "done_timestamp": now},
+            "$unset": {"lease_expires_at": ""},
+        }
+
+    def release_task(self, task_id, max_attempts=None, error=None):
+        """
+        Put an in-progress task back to the waiting queue, keeping its original
+        timestamp so it does not lose its place, e.g. when the dispatch failed.
+        :param max_attempts: If set, a task claimed this many times is marked failed instead.
+        :param error: Reason recorded on the task.
+        :return: True if the task was re-queued or failed.
+        """
+        query = {"task_id": task_id, "status": TaskStatus.IN_PROGRESS.state}
+        if max_attempts is not None:
+            result = self.tasks.update_one({**query, "attempts": {"$gte": max_attempts}}, self._fail_update(error))
+            if result.modified_count:
+                self.status_events.publish(task_id)
+                return True
+        result = self.tasks.update_one(
+            query,
+            {
+                "$set": {"status": TaskStatus.WAITING.state, "queued_at": datetime.now().isoformat(), "last_error": error},
+                "$unset": {"machine_ip": "", "claimed_at": "", "lease_expires_at": ""},
+            },
+        )
+        if result.modified_count:
+            self.notifier.notify()
+            self.status_events.publish(task_id)
+        return result.modified_count > 0
+
+    def requeue_expired_tasks(self, max_attempts=None):
+        """
+        Re-queue in-progress tasks whose lease has expired.
+        :param max_attempts: If set, expired tasks claimed this many times are marked failed instead.
+        :return: The number of re-queued tasks.
+        """
+        now = datetime.now().isoformat()
+        query = {
+            "status": TaskStatus.IN_PROGRESS.state,
+            "lease_expires_at": {"$lt": now},
+        }
+        if max_attempts is not None:
+            failed = self.tasks.update_many(
+                {**query, "attempts": {"$gte": max_attempts}},
+                self._fail_update(f'Lease expired after {max_attempts} attempts'),
+            )
+            if failed.modified_count:
+                print(f"Failed {failed.modified_count} tasks after {max_attempts} attempts.")
+                self.status_events.publish_all()
+            query["attempts"] = {"$lt": max_attempts}
+        result = self.tasks.update_many(
+            query,
+            {
+                "$set": {"status": TaskStatus.WAITING.state, "queued_at": now},
+                "$unset": {"machine_ip": "", "claimed_at": "", "lease_expires_at": ""},
+            },
+        )
+        if result.modified_count:
+            self.notifier.notify()
+            self.status_events.publish_all()
+        return result.modified_count
+
     def move_task_to_in_progress(self, task_id, machine_ip):
         """
-        Move a task from waiting to in-progress collection and set the machine IP.
+        Move a task from waiting to in-progress and set the machine IP.
+        Kept for backward compatibility, see claim_task.
         :param task_id: The unique task ID.
         :param machine_ip: The IP address of the machine processing the task.
         """
-        task = self.waiting.find_one_and_delete({"task_id": task_id})
-        if task:
-            task['machine_ip'] = machine_ip  # Set the machine IP address on the task document
-            self.in_progress.insert_one(task)
+        return self.claim_task(task_id, machine_ip) is not None
 
     def move_task_to_done(self, task_id, file_path=''):
         """
-        Move a task from in-progress to done collection.
+        Mark a task as done. A task whose lease expired and that was re-queued
+        is still accepted, the result of the first worker to finish wins.
         :param task_id: The unique task ID.
         :param file_path: The new file path for the task result.
         """
-        task = self.in_progress.find_one_and_delete({"task_id": task_id})
-        if task:
-            task['file_path'] = file_path
-            task['done_timestamp'] = datetime.now().isoformat()
-            self.done.insert_one(task)
+        done_timestamp = datetime.now().isoformat()
+        result = self.tasks.update_one(
+            {
+                "task_id": task_id,
+                "status": {"$in": [TaskStatus.WAITING.state, TaskStatus.IN_PROGRESS.state]},
+            },
+            {
+                "$set": {
+                    "status": TaskStatus.DONE.state,
+                    "file_path": file_path,
+                    "done_timestamp": done_timestamp,
+                    "last_access": done_timestamp,
+                },
+                "$unset": {"lease_expires_at": ""},
+            },
+        )
+        if result.modified_count:
+            self.result_path_cache.set(task_id, file_path)
+            self.status_events.publish(task_id)
+        return result.modified_count > 0
 
     def get_user_id_by_task_id(self, task_id):
-        for status in [TaskStatus.DONE, TaskStatus.WAITING, TaskStatus.IN_PROGRESS]:
-            collection = self.get_collection(status)
-            task = collection.find_one({"task_id": task_id})
-            if task:
-                return task.get("user_id")  # Assuming 'user_id' is the field name
-        return None
+        task = self.tasks.find_one({"task_id": task_id}, {"user_id": 1})
+        return task.get("user_id") if task else None
 
 
     def get_file_path_by_task_id(self, task_id):
@@ -141,9 +411,16 @@ class TaskDatabase:
         :param task_id: The unique identifier of the task.
         :return: The file path of the task's result or None if not found.
         """
-        task_document = self.done.find_one({"task_id": task_id})
+        file_path = self.result_path_cache.get(task_id)
+        if file_path is not MISSING:
+            return file_path
+        task_document = self.tasks.find_one(
+            {"task_id": task_id, "status": TaskStatus.DONE.state}, {"file_path": 1}
+        )
         if task_document:
-            return task_document.get("file_path")  # Assuming 'file_path' is the key for the file path
+            file_path = task_document.get("file_path")  # Assuming 'file_path' is the key for the file path
+            self.result_path_cache.set(task_id, file_path)
+            return file_path
         else:
             return None
 
@@ -151,7 +428,10 @@ class TaskDatabase:
     def delete_old_tasks(self, days):
         cutoff_date = datetime.now() - timedelta(days=days)
         cutoff_timestamp = cutoff_date.isoformat()
-        result = self.done.delete_many({"done_timestamp": {"$lt": cutoff_timestamp}})
+        result = self.tasks.delete_many({
+            "status": TaskStatus.DONE.state,
+            "done_timestamp": {"$lt": cutoff_timestamp},
+        })
         print(f"Deleted {result.deleted_count} tasks.")
 
 
@@ -162,8 +442,7 @@ class TaskDatabase:
         :param uuid: The UUID to check for in the collection.
         :return: True if the UUID is found, False otherwise.
         """
-        document = self.user_db.find_one({"uuid": uuid})
-        return bool(document)
+        return self.uuid_exists(uuid)
 
 
     def update_collection_with_prop(self, uuid, propetry_value, propetry_name):
@@ -171,6 +450,7 @@ class TaskDatabase:
             {"uuid": uuid},
             {"$set": {propetry_name: propetry_value}}
         )
+        self.user_cache.invalidate(uuid)
         if result.modified_count > 0:
             return True
         else:
@@ -179,53 +459,108 @@ class TaskDatabase:
 
     def retrieve_oldest_wait_task(self):
         """
-        Retrieve the oldest waiting task.
+        Retrieve the oldest waiting task without claiming it.
         :return: A dictionary containing task details or None if not found.
         """
-        task = self.waiting.find_one(sort=[("timestamp", 1)])
+        task = self.tasks.find_one(
+            {"status": TaskStatus.WAITING.state}, sort=[("timestamp", ASCENDING)]
+        )
         return parse_task(task) if task else None
 
     def retrieve_all_tasks(self, collection):
         """
-        Retrieve all tasks from a specified collection.
-        :param collection: The collection to retrieve tasks from.
+        Retrieve all tasks with a given status.
+        :param collection: The status to retrieve tasks for, one of TASK_STATES.
         :return: A list of task dictionaries.
         """
-        if collection == 'waiting':
-            tasks = self.waiting.find(sort=[("timestamp", 1)])
-        elif collection == 'in_progress':
-            tasks = self.in_progress.find()
-        elif collection == 'done':
-            tasks = self.done.find()
-        else:
+        if collection not in TASK_STATES:
             return None
+        tasks = self.tasks.find({"status": collection}, sort=[("timestamp", ASCENDING)])
+        return [parse_task(task) for task in tasks]
 
-        return [parse_task(task) for task in tasks] if tasks else None
+    @staticmethod
+    def _projection(fields):
+        if fields is None:
+            return None
+        projection = {field: 1 for field in fields}
+        if 'objects' in projection:
+            del projection['objects']
+            projection['objects_json'] = 1
+        projection.setdefault('_id', 0)
+        return projection
+
+    def get_tasks(self, task_ids, fields=None):
+        """
+        Fetch many tasks with one indexed $in query.
+        :param task_ids: Iterable of task IDs.
+        :param fields: Optional list of fields to return, e.g. ['status', 'file_path'].
+        :return: A dictionary task_id -> parsed task, missing tasks are left out.
+        """
+        projection = self._projection(fields)
+        if projection is not None:
+            projection['task_id'] = 1
+        cursor = self.tasks.find({"task_id": {"$in": list(task_ids)}}, projection)
+        return {task['task_id']: parse_task(task) for task in cursor}
+
+    def iter_tasks(self, status, after=None, limit=100, projection=None):
+        """
+        Read one page of tasks with a given status in (timestamp, task_id) order.
+        Pages are addressed by the position of the last task seen rather than
+        an offset, so every page is a single range scan of the status index.
+        :param status: One of TASK_STATES.
+        :param after: The next_after value returned for the previous page, None for the first page.
+        :param limit: Maximum number of tasks in the page.
+        :param projection: Optional list of fields to return.
+        :return: (list of parsed tasks, next_after or None if this was the last page).
+        """
+        query = {"status": status}
+        if after is not None:
+            timestamp, task_id = after
+            query["$or"] = [
+                {"timestamp": {"$gt": timestamp}},
+                {"timestamp": timestamp, "task_id": {"$gt": task_id}},
+            ]
+        projection = self._projection(projection)
+        if projection is not None:
+            projection.update({"timestamp": 1, "task_id": 1})
+        cursor = self.tasks.find(
+            query, projection,
+            sort=[("timestamp", ASCENDING), ("task_id", ASCENDING)],
+            limit=limit,
+        )
+        tasks = [parse_task(task) for task in cursor]
+        next_after = None
+        if len(tasks) == limit:
+            next_after = (tasks[-1]['timestamp'], tasks[-1]['task_id'])
+        return tasks, next_after
+
+    def count_by_status(self):
+        """
+        :return: A dictionary status -> number of tasks, with every status present.
+        """
+        counts = {state: 0 for state in TASK_STATES}
+        for row in self.tasks.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+            counts[row['_id']] = row['count']
+        return counts
 
     def close(self):
         self.client.close()
 
     def remove_task(self, task_id, collection):
         """
-        Remove a task from a specified collection.
+        Remove a task if it has the given status.
         :param task_id: The unique task ID.
-        :param collection: The collection to remove the task from.
+        :param collection: The status of the task, one of TASK_STATES.
         """
-        if collection == 'waiting':
-            self.waiting.delete_one({"task_id": task_id})
-        elif collection == 'in_progress':
-            self.in_progress.delete_one({"task_id": task_id})
-        elif collection == 'done':
-            self.done.delete_one({"task_id": task_id})
+        if collection in TASK_STATES:
+            self.tasks.delete_one({"task_id": task_id, "status": collection})
+            self.result_path_cache.invalidate(task_id)
 
     def remove_all_tasks(self, collection):
         """
-        Remove all tasks from a specified collection.
-        :param collection: The collection to remove all tasks from.
+        Remove all tasks with a given status.
+        :param collection: The status of the tasks, one of TASK_STATES.
         """
-        if collection == 'waiting':
-            self.waiting.delete_many({})
-        elif collection == 'in_progress':
-            self.in_progress.delete_many({})
-        elif collection == 'done':
-            self.done.delete_many({})
+        if collection in TASK_STATES:
+            self.tasks.delete_many({"status": collection})
+            self.result_path_cache.clear()
@@ -0,0 +1,190 @@
+import time
+import heapq
+import queue
+import itertools
+import threading
+import collections
+
+from apns2.client import APNsClient
+from apns2.payload import Payload
+
+
+Notification = collections.namedtuple('Notification', ['token', 'payload'])
+
+# APNs reasons meaning the device token will never work again
+INVALID_TOKEN_REASONS = {'BadDeviceToken', 'Unregistered', 'DeviceTokenNotForTopic'}
+
+
+class APNsTransport:
+    """
+    One long-lived APNs HTTP/2 client, created on first use and recreated
+    after a connection error.
+    """
+    def __init__(self, key_path='key.pem', use_sandbox=False):
+        self.key_path = key_path
+        self.use_sandbox = use_sandbox
+        self.client = None
+
+    def send_batch(self, notifications, topic):
+        """
+        :return: A dictionary token -> 'Success' or the APNs failure reason.
+        """
+        if self.client is None:
+            self.client = APNsClient(self.key_path, use_sandbox=self.use_sandbox, use_alternative_port=False)
+        try:
+            return self.client.send_notification_batch(notifications=notifications, topic=topic)
+        except Exception:
+            self.client = None
+            raise
+
+
+class StubTransport:
+    """
+    Offline transport for tests: records every batch and answers with
+    `responses[token]` or 'Success'.
+    """
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.batches = []
+
+    def send_batch(self, notifications, topic):
+        self.batches.append((topic, list(notifications)))
+        return {n.token: self.responses.get(n.token, 'Success') for n in notifications}
+
+
+class NotificationService:
+    """
+    Queue push notifications and send them from a background thread.
+
+    enqueue() never blocks on APNs. The flusher waits up to `flush_window`
+    seconds after the first pending notification to coalesce more of them
+    into one send_notification_batch call. Invalid tokens are dropped and
+    reported to `on_invalid_token`, other failures are retried up to
+    `max_retries` times, the n-th retry `retry_backoff * 2 ** (n - 1)`
+    seconds after the failure. A failing batch or callback is logged and
+    never stops the flusher.
+
+    :param transport: APNsTransport or StubTransport.
+    :param topic: APNs topic (the app bundle id).
+    :param max_queue: Pending notifications beyond this are dropped.
+    :param flush_window: Seconds to wait for more notifications before sending a batch.
+    :param max_batch: Largest number of notifications per batch.
+    :param max_retries: Sends attempted per notification.
+    :param retry_backoff: Seconds before the first retry, doubled for every further one.
+    :param on_invalid_token: Optional callable receiving a token APNs rejected for good.
+    """
+    def __init__(
+            self,
+            transport,
+            topic='com.example.App',
+            max_queue=10000,
+            flush_window=0.2,
+            max_batch=100,
+            max_retries=3,
+            retry_backoff=1.0,
+            on_invalid_token=None,
+        ):
+        self.transport = transport
+        self.topic = topic
+        self.flush_window = flush_window
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.on_invalid_token = on_invalid_token
+        self.queue = queue.Queue(maxsize=max_queue)
+        # (due time, sequence, notification, attempt), only touched by the flusher thread
+        self.retries = []
+        self.retry_sequence = itertools.count()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.sent = 0
+        self.dropped = 0
+
+    def enqueue(self, token_hex, message, badge=1):
+        """
+        :return: False if the queue is full and the notification was dropped.
+        """
+        payload = Payload(alert=message, sound="default", badge=badge)
+        return self._put(Notification(token=token_hex, payload=payload), 0)
+
+    def _put(self, notification, attempt):
+        try:
+            self.queue.put_nowait((notification, attempt))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            print(f"Notification queue full, dropping notification for {notification.token}")
+            return False
+
+    def _schedule_retry(self, notification, attempt):
+        due = time.monotonic() + self.retry_backoff * 2 ** (attempt - 1)
+        heapq.heappush(self.retries, (due, next(self.retry_sequence), notification, attempt))
+
+    def _requeue_due_retries(self):
+        now = time.monotonic()
+        while self.retries and self.retries[0][0] <= now:
+            _, _, notification, attempt = heapq.heappop(self.retries)
+            self._put(notification, attempt)
+
+    def _collect_batch(self):
+        try:
+            batch = [self.queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, batch):
+        notifications = [notification for notification, _ in batch]
+        try:
+            results = self.transport.send_batch(notifications, self.topic)
+        except Exception as e:
+            print(f"Sending {len(batch)} notifications failed: {e}")
+            results = {notification.token: str(e) for notification in notifications}
+
+        for notification, attempt in batch:
+            result = results.get(notification.token, 'Success')
+            if result == 'Success':
+                self.sent += 1
+            elif result in INVALID_TOKEN_REASONS:
+                self.dropped += 1
+                if self.on_invalid_token is not None:
+                    try:
+                        self.on_invalid_token(notification.token)
+                    except Exception as e:
+                        print(f"Forgetting invalid token {notification.token} failed: {e}")
+            elif attempt + 1 < self.max_retries:
+                self._schedule_retry(notification, attempt + 1)
+            else:
+                self.dropped += 1
+                print(f"Giving up on notification for {notification.token}: {result}")
+
+    def run(self):
+        while not self.stopped.is_set() or not self.queue.empty():
+            self._requeue_due_retries()
+            batch = self._collect_batch()
+            if not batch:
+                continue
+            try:
+                self.flush(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                print(f"Flushing {len(batch)} notifications failed: {e}")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
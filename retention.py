@@ -0,0 +1,183 @@
+import os
+import json
+import shutil
+from pathlib import Path
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import ASCENDING
+
+from mongo_handler import TaskStatus
+
+
+def reclaimable_size(path):
+    """
+    Bytes freed by removing a file. A hard link to a ContentStore blob frees
+    nothing, the blob's bytes are freed by ContentStore.release.
+    """
+    stat = os.lstat(path)
+    return stat.st_size if stat.st_nlink <= 1 else 0
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += reclaimable_size(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def task_directory(blob_storage, task):
+    """
+    The blob storage folder of a task. Paths outside blob storage are never returned.
+    """
+    blob_storage = Path(blob_storage).resolve()
+    for path in (task.get('original_video_path'), task.get('file_path')):
+        if path:
+            directory = Path(path).resolve().parent
+            if directory.parent == blob_storage:
+                return directory
+    directory = (blob_storage / task['task_id']).resolve()
+    return directory if directory.parent == blob_storage else None
+
+
+# Failed tasks carry a done_timestamp too and expire with the done ones
+RETIRED_STATES = [TaskStatus.DONE.state, TaskStatus.FAILED.state]
+
+
+def delete_task_files(blob_storage, task):
+    """
+    Remove the task folder and a result stored outside of it.
+    :return: Number of bytes reclaimed.
+    """
+    reclaimed = 0
+    directory = task_directory(blob_storage, task)
+    if directory is not None and directory.is_dir():
+        reclaimed += directory_size(directory)
+        shutil.rmtree(directory, ignore_errors=True)
+    # Results stored outside the task folder are removed on their own
+    file_path = task.get('file_path')
+    if file_path and os.path.isfile(file_path):
+        try:
+            reclaimed += reclaimable_size(file_path)
+            os.remove(file_path)
+        except OSError as e:
+            print(f"Error deleting {file_path}: {e}")
+    return reclaimed
+
+
+class RetentionEngine:
+    """
+    Incremental deletion of done and failed tasks older than the retention period.
+
+    Each run scans the (status, done_timestamp) index in bounded batches from
+    the oldest expired task, removes whole task directories from blob storage
+    in a small thread pool, deletes the batch with one delete_many and saves
+    the progress to the checkpoint, so it is cheap enough to run every few minutes.
+
+    :param task_db: TaskDatabase of the service.
+    :param blob_storage: Root directory of the task folders.
+    :param days: Retention period of done tasks.
+    :param batch_size: Number of tasks handled per batch.
+    :param max_batches: Upper bound of batches per run, None for no bound.
+    :param delete_threads: Threads removing task directories.
+    :param checkpoint_path: JSON file keeping the progress stats between runs.
+    :param storage: Optional StorageAccounting whose usage totals are decreased
+        and whose ContentStore releases the input blobs of deleted tasks.
+    """
+    def __init__(
+            self,
+            task_db,
+            blob_storage,
+            days=7,
+            batch_size=500,
+            max_batches=None,
+            delete_threads=4,
+            checkpoint_path='files/retention_checkpoint.json',
+            storage=None,
+        ):
+        self.task_db = task_db
+        self.blob_storage = Path(blob_storage).resolve()
+        self.days = days
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.delete_threads = delete_threads
+        self.checkpoint_path = checkpoint_path
+        self.storage = storage
+
+    def ensure_indexes(self):
+        # Includes the (status, done_timestamp) index the batches are read from
+        self.task_db.ensure_indexes()
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'done_timestamp': None, 'deleted_tasks': 0, 'reclaimed_bytes': 0}
+
+    def save_checkpoint(self, checkpoint):
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f, indent=4)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def delete_task_files(self, task):
+        return delete_task_files(self.blob_storage, task)
+
+    def next_batch(self, cutoff_timestamp):
+        # No lower bound: deleted tasks leave the index, and a task whose deletion
+        # failed or that finished with an older done_timestamp must still be found
+        return list(self.task_db.tasks.find(
+            {"status": {"$in": RETIRED_STATES}, "done_timestamp": {"$lt": cutoff_timestamp}},
+            {
+                "task_id": 1, "file_path": 1, "original_video_path": 1, "done_timestamp": 1,
+                "user_id": 1, "upload_bytes": 1, "result_bytes": 1, "evicted": 1, "content_digest": 1,
+            },
+            sort=[("done_timestamp", ASCENDING)],
+            limit=self.batch_size,
+        ))
+
+    def delete_batch(self, tasks, executor):
+        reclaimed = sum(executor.map(self.delete_task_files, tasks))
+        task_ids = [task['task_id'] for task in tasks]
+        result = self.task_db.tasks.delete_many(
+            {"task_id": {"$in": task_ids}, "status": {"$in": RETIRED_STATES}}
+        )
+        for task_id in task_ids:
+            self.task_db.result_path_cache.invalidate(task_id)
+        if self.storage is not None:
+            reclaimed += self.storage.release(tasks)
+        return result.deleted_count, reclaimed
+
+    def run_once(self):
+        """
+        :return: (tasks deleted, bytes reclaimed) in this run.
+        """
+        cutoff_timestamp = (datetime.now() - timedelta(days=self.days)).isoformat()
+        checkpoint = self.load_checkpoint()
+        deleted_total, reclaimed_total, batches = 0, 0, 0
+
+        with ThreadPoolExecutor(max_workers=self.delete_threads) as executor:
+            while self.max_batches is None or batches < self.max_batches:
+                tasks = self.next_batch(cutoff_timestamp)
+                if not tasks:
+                    break
+                deleted, reclaimed = self.delete_batch(tasks, executor)
+                deleted_total += deleted
+                reclaimed_total += reclaimed
+                batches += 1
+
+                checkpoint['done_timestamp'] = tasks[-1]['done_timestamp']
+                checkpoint['deleted_tasks'] += deleted
+                checkpoint['reclaimed_bytes'] += reclaimed
+                self.save_checkpoint(checkpoint)
+                if len(tasks) < self.batch_size:
+                    break
+
+        print(f"Retention: deleted {deleted_total} tasks, reclaimed {reclaimed_total / 1e6:.1f} MB "
+              f"in {batches} batches (total {checkpoint['reclaimed_bytes'] / 1e9:.2f} GB)")
+        return deleted_total, reclaimed_total
@@ -0,0 +1,307 @@
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING
+
+from mongo_handler import TaskStatus, parse_task
+
+
+MIN_WEIGHT = 0.01
+
+
+class FifoPolicy:
+    """
+    Oldest waiting task first, the order of retrieve_oldest_wait_task.
+    """
+    def __init__(self, task_db):
+        self.task_db = task_db
+
+    def ensure_indexes(self):
+        self.task_db.ensure_indexes()
+
+    def oldest_tasks(self, limit, projection=None):
+        tasks, _ = self.task_db.iter_tasks(TaskStatus.WAITING.state, limit=limit, projection=projection)
+        return tasks
+
+    def now(self):
+        return datetime.now()
+
+    def aged_tasks(self, cutoff, limit, projection=None):
+        return self.find_tasks(
+            {"status": TaskStatus.WAITING.state, "timestamp": {"$lt": cutoff}},
+            limit, projection,
+        )
+
+    def find_tasks(self, query, limit, projection=None, sort=None):
+        cursor = self.task_db.tasks.find(
+            query,
+            self.task_db._projection(projection),
+            sort=sort or [("timestamp", ASCENDING), ("task_id", ASCENDING)],
+            limit=limit,
+        )
+        return [parse_task(task) for task in cursor]
+
+    def select(self, limit, projection=None):
+        """
+        :return: Up to `limit` waiting tasks in the order they should be dispatched.
+        """
+        return self.oldest_tasks(limit, projection)
+
+    def order(self, limit, projection=None):
+        """
+        :return: Up to `limit` waiting tasks in dispatch order, leaving the policy state unchanged.
+        """
+        return self.select(limit, projection)
+
+
+class FairSharePolicy(FifoPolicy):
+    """
+    Priority classes, deficit round-robin across users and aging.
+
+    Tasks carry an integer `priority`; the highest class with waiting tasks
+    is served first. Within a class, users take turns by deficit round-robin:
+    each turn adds `quantum * weight` to the user's deficit and every task
+    costs 1, so a user with 50 queued clips gets the same share as a user
+    with one. The weight is the user document's 'weight' property (default 1).
+    A user's own tasks go oldest first. Tasks waiting longer than `max_wait`
+    seconds bypass all of this and go out oldest first, so nothing starves.
+
+    Every pick is an index range read: the aged tasks and the top class come
+    from (status, timestamp) and (status, priority) prefixes, a user's head
+    from (status, priority, user_id, timestamp). The set of users with
+    waiting tasks is refreshed with a distinct scan every `refresh_interval`
+    seconds, and the round-robin state lives in memory.
+
+    :param task_db: TaskDatabase of the service.
+    :param quantum: Deficit added per turn for weight 1.
+    :param max_wait: Seconds after which a task is dispatched regardless of its user and priority, None disables aging.
+    :param refresh_interval: Seconds between two reads of the active users.
+    :param default_weight: Weight of users without a 'weight' property.
+    """
+    def __init__(self, task_db, quantum=1.0, max_wait=600, refresh_interval=5.0, default_weight=1.0):
+        super().__init__(task_db)
+        self.quantum = quantum
+        self.max_wait = max_wait
+        self.refresh_interval = refresh_interval
+        self.default_weight = default_weight
+        self.ring = deque()
+        self.deficits = {}
+        self.ring_priority = None
+        self.refreshed_at = None
+        # True while the user at the head of the ring has been credited its quantum
+        self.turn_open = False
+
+    def ensure_indexes(self):
+        super().ensure_indexes()
+        self.task_db.tasks.create_index([
+            ("status", ASCENDING), ("priority", DESCENDING), ("user_id", ASCENDING),
+            ("timestamp", ASCENDING), ("task_id", ASCENDING),
+        ])
+
+    def top_priority(self):
+        """
+        :return: (True, priority of the highest waiting class) or (False, None) if nothing waits.
+        """
+        task = self.task_db.tasks.find_one(
+            {"status": TaskStatus.WAITING.state}, {"priority": 1}, sort=[("priority", DESCENDING)]
+        )
+        if task is None:
+            return False, None
+        # Tasks queued before priorities existed have none, {"priority": None} matches them
+        return True, task.get('priority')
+
+    def active_users(self, priority):
+        return self.task_db.tasks.distinct(
+            "user_id", {"status": TaskStatus.WAITING.state, "priority": priority}
+        )
+
+    def user_tasks(self, priority, user_id, limit, projection=None):
+        return self.find_tasks(
+            {"status": TaskStatus.WAITING.state, "priority": priority, "user_id": user_id},
+            limit, projection,
+        )
+
+    def weight(self, user_id):
+        weight = self.task_db.get_user_db_property(user_id, 'weight')
+        try:
+            return max(float(weight), MIN_WEIGHT) if weight is not None else self.default_weight
+        except (TypeError, ValueError):
+            return self.default_weight
+
+    def refresh_ring(self, priority):
+        users = self.active_users(priority)
+        head = self.ring[0] if self.ring else None
+        if priority != self.ring_priority:
+            self.ring = deque(users)
+            self.deficits = {}
+        else:
+            # Keep the turn order of known users, newcomers queue up at the end
+            active = set(users)
+            known = [user for user in self.ring if user in active]
+            self.ring = deque(known + [user for user in users if user not in set(known)])
+            self.deficits = {user: self.deficits[user] for user in known if user in self.deficits}
+        if not self.ring or self.ring[0] != head:
+            self.turn_open = False
+        self.ring_priority = priority
+        self.refreshed_at = time.monotonic()
+
+    def select(self, limit, projection=None):
+        if projection is not None:
+            projection = list(projection) + ['user_id', 'priority', 'timestamp', 'task_id']
+        selected = []
+        if self.max_wait is not None:
+            cutoff = (self.now() - timedelta(seconds=self.max_wait)).isoformat()
+            selected = self.aged_tasks(cutoff, limit, projection)
+        if len(selected) >= limit:
+            return selected
+
+        found, priority = self.top_priority()
+        if not found:
+            return selected
+        if (priority != self.ring_priority or not self.ring
+                or time.monotonic() - self.refreshed_at > self.refresh_interval):
+            self.refresh_ring(priority)
+
+        picked = {task['task_id'] for task in selected}
+        queues = {}
+        remaining = limit - len(selected)
+        while remaining > 0 and self.ring:
+            user_id = self.ring[0]
+            if user_id not in queues:
+                queues[user_id] = deque(
+                    task for task in self.user_tasks(priority, user_id, remaining + len(picked), projection)
+                    if task['task_id'] not in picked
+                )
+            queue = queues[user_id]
+            if not queue:
+                # An idle user leaves the round and loses its deficit, as in DRR
+                self.ring.popleft()
+                self.deficits.pop(user_id, None)
+                self.turn_open = False
+                continue
+            deficit = self.deficits.get(user_id, 0.0)
+            if not self.turn_open:
+                deficit += self.quantum * self.weight(user_id)
+            while queue and deficit >= 1 and remaining > 0:
+                selected.append(queue.popleft())
+                deficit -= 1
+                remaining -= 1
+            self.deficits[user_id] = deficit
+            # A turn cut short by the limit continues on the next call without a new quantum
+            self.turn_open = remaining == 0 and deficit >= 1 and bool(queue)
+            if not self.turn_open:
+                self.ring.rotate(-1)
+        return selected
+
+    def order(self, limit, projection=None):
+        # Run a selection on a copy of the round-robin state
+        state = (deque(self.ring), dict(self.deficits), self.ring_priority, self.refreshed_at, self.turn_open)
+        try:
+            return self.select(limit, projection)
+        finally:
+            self.ring, self.deficits, self.ring_priority, self.refreshed_at, self.turn_open = state
+
+
+class ShortestJobFirstPolicy(FifoPolicy):
+    """
+    Shortest expected job first, with aging.
+
+    The ThroughputModel predicts overhead + slope * cost.units with a
+    non-negative slope on every worker, so ordering by the `units` cost
+    feature from the (status, cost.units) index is the shortest-expected-job
+    order without evaluating the model per task. Tasks waiting longer than
+    `max_wait` seconds go first, oldest first, so long clips still get out.
+    Tasks queued before cost features were recorded sort as the shortest.
+
+    :param task_db: TaskDatabase of the service.
+    :param max_wait: Seconds after which a task is dispatched regardless of its cost, None disables aging.
+    """
+    def __init__(self, task_db, max_wait=600):
+        super().__init__(task_db)
+        self.max_wait = max_wait
+
+    def ensure_indexes(self):
+        super().ensure_indexes()
+        self.task_db.tasks.create_index([
+            ("status", ASCENDING), ("cost.units", ASCENDING), ("timestamp", ASCENDING), ("task_id", ASCENDING),
+        ])
+
+    def shortest_tasks(self, limit, projection=None):
+        return self.find_tasks(
+            {"status": TaskStatus.WAITING.state}, limit, projection,
+            sort=[("cost.units", ASCENDING), ("timestamp", ASCENDING), ("task_id", ASCENDING)],
+        )
+
+    def select(self, limit, projection=None):
+        if projection is not None:
+            projection = list(projection) + ['cost', 'timestamp', 'task_id']
+        selected = []
+        if self.max_wait is not None:
+            cutoff = (self.now() - timedelta(seconds=self.max_wait)).isoformat()
+            selected = self.aged_tasks(cutoff, limit, projection)
+        picked = {task['task_id'] for task in selected}
+        for task in self.shortest_tasks(limit + len(selected), projection):
+            if len(selected) >= limit:
+                break
+            if task['task_id'] not in picked:
+                selected.append(task)
+        return selected
+
+
+class DeadlinePolicy(FifoPolicy):
+    """
+    Earliest deadline first, skipping tasks that can no longer make it.
+
+    Every task gets a `deadline` at upload, requested by the client or the
+    server default. The `lookahead * limit` earliest deadlines are read from
+    the (status, deadline) index. A task whose slack (time left until the
+    deadline minus the expected processing time from the ThroughputModel)
+    is already negative waits behind the ones that can still be on time, so
+    under overload late tasks do not make the others late too. Tasks without
+    a deadline (queued before deadlines existed) go first.
+
+    :param task_db: TaskDatabase of the service.
+    :param model: Optional ThroughputModel, without it only the deadline itself counts.
+    :param lookahead: Candidates read per selected task.
+    """
+    def __init__(self, task_db, model=None, lookahead=4):
+        super().__init__(task_db)
+        self.model = model
+        self.lookahead = lookahead
+
+    def ensure_indexes(self):
+        super().ensure_indexes()
+        self.task_db.tasks.create_index([
+            ("status", ASCENDING), ("deadline", ASCENDING), ("timestamp", ASCENDING), ("task_id", ASCENDING),
+        ])
+
+    def earliest_tasks(self, limit, projection=None):
+        return self.find_tasks(
+            {"status": TaskStatus.WAITING.state}, limit, projection,
+            sort=[("deadline", ASCENDING), ("timestamp", ASCENDING), ("task_id", ASCENDING)],
+        )
+
+    def slack(self, task, now):
+        if not task.get('deadline'):
+            return float('-inf')
+        slack = (datetime.fromisoformat(task['deadline']) - now).total_seconds()
+        if self.model is not None:
+            slack -= self.model.predict((task.get('cost') or {}).get('units')) or 0
+        return slack
+
+    def arrange(self, candidates, limit):
+        now = self.now()
+        # Candidates come in deadline order, tasks that can no longer make it wait behind those that can
+        return sorted(candidates, key=lambda task: self.slack(task, now) < 0 and bool(task.get('deadline')))[:limit]
+
+    def select(self, limit, projection=None):
+        if projection is not None:
+            projection = list(projection) + ['cost', 'deadline', 'timestamp', 'task_id']
+        return self.arrange(self.earliest_tasks(limit * self.lookahead, projection), limit)
+
+    def order(self, limit, projection=None):
+        # Over the whole queue the lookahead adds nothing
+        if projection is not None:
+            projection = list(projection) + ['cost', 'deadline', 'timestamp', 'task_id']
+        return self.arrange(self.earliest_tasks(limit, projection), limit)
@@ -0,0 +1,168 @@
+import threading
+from datetime import datetime
+
+from pymongo import ASCENDING, ReturnDocument
+
+from mongo_handler import TaskStatus
+from retention import delete_task_files
+from ttl_cache import TTLCache, MISSING
+
+
+EVICTION_POLICIES = {
+    'lru': 'last_access',
+    'oldest_done': 'done_timestamp',
+}
+SIZE_FIELDS = ('upload_bytes', 'result_bytes')
+
+
+class StorageAccounting:
+    """
+    Blob storage usage per user and in total, with size-aware eviction.
+
+    Sizes are recorded on the task document (upload_bytes, result_bytes) and
+    running totals are kept with atomic $inc in the storage_usage collection.
+    When the total crosses `high_water_bytes`, done results are evicted in
+    policy order ('lru' by last /get_task_result access, or 'oldest_done')
+    until usage is back under `low_water_ratio` of the mark. Evicted tasks
+    keep their document with evicted=True, so the API can answer 410 Gone.
+    Uploads kept in a ContentStore are accounted once per blob by the store,
+    which attaches itself as `content_store` so released tasks drop their
+    blob reference.
+
+    :param task_db: TaskDatabase of the service.
+    :param blob_storage: Root directory of the task folders.
+    :param high_water_bytes: Usage that triggers eviction, None disables it.
+    :param low_water_ratio: Eviction stops below this fraction of the high-water mark.
+    :param policy: 'lru' or 'oldest_done'.
+    :param batch_size: Tasks evicted per query.
+    :param touch_interval: last_access is written at most once per this many seconds per task.
+    """
+    def __init__(
+            self,
+            task_db,
+            blob_storage,
+            high_water_bytes=None,
+            low_water_ratio=0.9,
+            policy='lru',
+            batch_size=50,
+            touch_interval=3600,
+        ):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy {policy}, expected one of {list(EVICTION_POLICIES)}")
+        self.task_db = task_db
+        self.tasks = task_db.tasks
+        self.usage_collection = task_db.db['storage_usage']
+        self.blob_storage = blob_storage
+        self.high_water_bytes = high_water_bytes
+        self.low_water_ratio = low_water_ratio
+        self.sort_field = EVICTION_POLICIES[policy]
+        self.batch_size = batch_size
+        self.touched = TTLCache(maxsize=100000, ttl=touch_interval)
+        self.eviction_lock = threading.Lock()
+        self.content_store = None
+
+    def ensure_indexes(self):
+        self.tasks.create_index([("status", ASCENDING), ("last_access", ASCENDING)])
+        self.tasks.create_index([("status", ASCENDING), ("done_timestamp", ASCENDING)])
+
+    def add_usage(self, user_id, delta):
+        if not delta:
+            return
+        self.usage_collection.update_one({"_id": "total"}, {"$inc": {"bytes": delta}}, upsert=True)
+        if user_id:
+            self.usage_collection.update_one({"_id": f"user:{user_id}"}, {"$inc": {"bytes": delta}}, upsert=True)
+
+    def usage(self, user_id=None):
+        key = f"user:{user_id}" if user_id else "total"
+        document = self.usage_collection.find_one({"_id": key})
+        return document['bytes'] if document else 0
+
+    def record_size(self, task_id, field, size):
+        """
+        Store the size of a task file and add the difference to the totals.
+        :param field: 'upload_bytes' or 'result_bytes'.
+        """
+        previous = self.tasks.find_one_and_update(
+            {"task_id": task_id},
+            {"$set": {field: size}},
+            projection={field: 1, "user_id": 1},
+            return_document=ReturnDocument.BEFORE,
+        )
+        if previous is None:
+            return
+        self.add_usage(previous.get('user_id'), size - previous.get(field, 0))
+
+    def release(self, tasks):
+        """
+        Subtract the sizes of deleted tasks from the totals and release their
+        input blobs. Evicted tasks were released already.
+        :return: Bytes freed by deleting blobs no task references any more.
+        """
+        freed = 0
+        for task in tasks:
+            if task.get('evicted'):
+                continue
+            size = sum(task.get(field, 0) for field in SIZE_FIELDS)
+            self.add_usage(task.get('user_id'), -size)
+            if self.content_store is not None and task.get('content_digest'):
+                freed += self.content_store.release(task['content_digest'])
+        return freed
+
+    def touch(self, task_id):
+        """
+        Record an access to a result for the LRU policy, throttled per task.
+        """
+        if self.touched.get(task_id) is not MISSING:
+            return
+        self.touched.set(task_id, True)
+        self.tasks.update_one({"task_id": task_id}, {"$set": {"last_access": datetime.now().isoformat()}})
+
+    def is_evicted(self, task_id):
+        return self.tasks.find_one({"task_id": task_id, "evicted": True}, {"_id": 1}) is not None
+
+    def over_high_water(self):
+        return self.high_water_bytes is not None and self.usage() > self.high_water_bytes
+
+    def evict(self):
+        """
+        Evict done results until usage is below the low-water mark.
+        :return: (evicted tasks, bytes reclaimed).
+        """
+        if self.high_water_bytes is None:
+            return 0, 0
+        target = self.high_water_bytes * self.low_water_ratio
+        evicted_count, reclaimed_total = 0, 0
+        with self.eviction_lock:
+            while self.usage() > target:
+                tasks = list(self.tasks.find(
+                    {"status": TaskStatus.DONE.state, "evicted": {"$ne": True}},
+                    {
+                        "task_id": 1, "user_id": 1, "file_path": 1, "original_video_path": 1,
+                        "upload_bytes": 1, "result_bytes": 1, "content_digest": 1,
+                    },
+                    sort=[(self.sort_field, ASCENDING)],
+                    limit=self.batch_size,
+                ))
+                if not tasks:
+                    break
+                for task in tasks:
+                    reclaimed_total += delete_task_files(self.blob_storage, task)
+                    self.task_db.result_path_cache.invalidate(task['task_id'])
+                self.tasks.update_many(
+                    {"task_id": {"$in": [task['task_id'] for task in tasks]}},
+                    {"$set": {"evicted": True, "evicted_at": datetime.now().isoformat()}},
+                )
+                reclaimed_total += self.release(tasks)
+                evicted_count += len(tasks)
+        if evicted_count:
+            print(f"Evicted {evicted_count} tasks, reclaimed {reclaimed_total / 1e6:.1f} MB")
+        return evicted_count, reclaimed_total
+
+    def maybe_evict(self):
+        """
+        Start eviction in a background thread if usage crossed the high-water mark.
+        """
+        if self.eviction_lock.locked() or not self.over_high_water():
+            return False
+        threading.Thread(target=self.evict, daemon=True).start()
+        return True
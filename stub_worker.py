@@ -0,0 +1,159 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import requests
+from flask import Flask, jsonify, request
+
+# Local stand-in for a processing worker, for testing the task manager.
+# It speaks the dispatch protocol: get_worker_status reports 'ready' or
+# 'busy', its capacity, running tasks and their ids and the digests of the cached
+# inputs, process_video accepts either a video upload or an 'input_digest'
+# offer and answers 409 on a cache miss.
+# "Processing" sleeps and posts the input back as the result.
+#
+# USE: python stub_worker.py --port 5000 --token <uuid of a registered user>
+
+parser = argparse.ArgumentParser(description="Stub video processing worker.")
+parser.add_argument('--host', default='0.0.0.0')
+parser.add_argument('--port', type=int, default=5000)
+parser.add_argument('--cache_dir', default='files/stub_worker_cache', help='Inputs kept by content digest.')
+parser.add_argument('--max_cached', type=int, default=50, help='Number of inputs kept in the cache.')
+parser.add_argument('--slots', type=int, default=1, help='Tasks processed concurrently.')
+parser.add_argument('--processing_seconds', type=float, default=2.0, help='Simulated processing time.')
+parser.add_argument('--token', default=None, help='Token header sent with the result.')
+args = parser.parse_args()
+
+app = Flask(__name__)
+
+cache_dir = Path(args.cache_dir)
+cache_dir.mkdir(parents=True, exist_ok=True)
+cached_inputs = OrderedDict((path.stem, True) for path in sorted(cache_dir.glob('*.mp4'), key=os.path.getmtime))
+lock = threading.Lock()
+running = {'tasks': 0, 'task_ids': set()}
+stats = {'hits': 0, 'misses': 0, 'uploads': 0}
+
+
+def cache_path(digest):
+    return cache_dir / f'{digest}.mp4'
+
+
+def remember(digest):
+    with lock:
+        cached_inputs[digest] = True
+        cached_inputs.move_to_end(digest)
+        while len(cached_inputs) > args.max_cached:
+            evicted, _ = cached_inputs.popitem(last=False)
+            cache_path(evicted).unlink(missing_ok=True)
+
+
+def save_upload(file, digest):
+    """
+    Store an uploaded video under its digest, verifying it when the digest is known.
+    """
+    tmp_path = cache_dir / f'upload-{threading.get_ident()}.part'
+    sha256 = hashlib.sha256()
+    with open(tmp_path, 'wb') as f:
+        for chunk in iter(lambda: file.stream.read(1 << 20), b''):
+            f.write(chunk)
+            sha256.update(chunk)
+    if digest and sha256.hexdigest() != digest:
+        tmp_path.unlink()
+        raise ValueError('Uploaded video does not match its content digest')
+    digest = sha256.hexdigest()
+    os.replace(tmp_path, cache_path(digest))
+    remember(digest)
+    return digest
+
+
+def process(config, digest):
+    try:
+        time.sleep(args.processing_seconds)
+        result_path = cache_dir / f"result-{config['task_id']}.mp4"
+        shutil.copyfile(cache_path(digest), result_path)
+        headers = {'token': args.token} if args.token else {}
+        with open(result_path, 'rb') as f:
+            requests.post(
+                config['response_url'],
+                data={'task_id': config['task_id']},
+                files={'video': (result_path.name, f)},
+                headers=headers,
+                timeout=60,
+            )
+        result_path.unlink()
+    except Exception as e:
+        print(f"Stub processing of task {config.get('task_id')} failed: {e}")
+    finally:
+        with lock:
+            running['tasks'] -= 1
+            running['task_ids'].discard(config.get('task_id'))
+
+
+@app.route('/get_worker_status', methods=['GET'])
+def get_worker_status():
+    with lock:
+        inputs = list(cached_inputs)
+        tasks = running['tasks']
+        task_ids = sorted(running['task_ids'])
+    return jsonify({
+        'status': 'ready' if tasks < args.slots else 'busy',
+        'capacity': args.slots,
+        'running': tasks,
+        'running_tasks': task_ids,
+        'cached_inputs': inputs,
+        **stats,
+    })
+
+
+@app.route('/process_video', methods=['POST'])
+def process_video():
+    with lock:
+        if running['tasks'] >= args.slots:
+            return jsonify({'error': 'Worker is busy'}), 503
+        # Reserve the slot before the upload is read
+        running['tasks'] += 1
+    try:
+        return start_task()
+    except Exception:
+        with lock:
+            running['tasks'] -= 1
+        raise
+
+
+def start_task():
+    config = json.loads(request.form['config'])
+    digest = config.get('content_digest')
+
+    if 'video' not in request.files:
+        offered = request.form.get('input_digest')
+        if not offered or not cache_path(offered).exists():
+            stats['misses'] += 1
+            with lock:
+                running['tasks'] -= 1
+            return jsonify({'error': 'Input not cached', 'input_digest': offered}), 409
+        stats['hits'] += 1
+        digest = offered
+        remember(digest)
+    else:
+        stats['uploads'] += 1
+        try:
+            digest = save_upload(request.files['video'], digest)
+        except ValueError as e:
+            with lock:
+                running['tasks'] -= 1
+            return jsonify({'error': str(e)}), 422
+
+    with lock:
+        running['task_ids'].add(config['task_id'])
+    threading.Thread(target=process, args=(config, digest), daemon=True).start()
+    return jsonify({'message': f"Task {config['task_id']} accepted", 'input_digest': digest}), 200
+
+
+if __name__ == '__main__':
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,176 @@
+import threading
+from collections import OrderedDict
+
+from pymongo.errors import PyMongoError
+
+
+class TaskNotifier:
+    """
+    In-process wake-up signal for the task queue. Every notify() bumps a
+    version counter, waiters pass the last version they saw so a notification
+    that arrives between checking the queue and waiting is never lost.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+
+    def notify(self):
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, version, timeout=None):
+        """
+        Block until the version differs from `version` or the timeout expires.
+        :return: The current version.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+
+class ChangeStreamWatcher:
+    """
+    Forward Mongo change stream events that make a task dispatchable (inserts
+    and updates setting status back to 'waiting') to a TaskNotifier.
+    Change streams require a replica set, on a standalone server the watcher
+    stops and the waiter falls back to polling.
+    """
+    pipeline = [{"$match": {"$or": [
+        {"operationType": "insert"},
+        {"operationType": "update", "updateDescription.updatedFields.status": "waiting"},
+    ]}}]
+
+    def __init__(self, collection, notifier):
+        self.collection = collection
+        self.notifier = notifier
+        self.available = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    watch_options = {}
+
+    def handle(self, change):
+        self.notifier.notify()
+
+    def run(self):
+        try:
+            with self.collection.watch(self.pipeline, max_await_time_ms=1000, **self.watch_options) as stream:
+                self.available = True
+                while not self.stopped.is_set():
+                    change = stream.try_next()
+                    if change is not None:
+                        self.handle(change)
+        except PyMongoError as e:
+            print(f"Change stream unavailable, falling back to polling: {e}")
+            self.available = False
+
+
+class TaskStatusBroadcaster:
+    """
+    Per-task change signal for clients waiting on task status.
+
+    publish(task_id) records the version at which a task last changed;
+    wait() blocks until one of the given tasks changed after `since`.
+    publish_all() marks every task as changed, for bulk updates whose
+    task IDs are not known.
+
+    :param max_tracked: Number of task versions kept, older ones fall back to the global version.
+    """
+    def __init__(self, max_tracked=100000):
+        self.condition = threading.Condition()
+        self.version = 0
+        self.all_changed_version = 0
+        self.changed = OrderedDict()
+        self.max_tracked = max_tracked
+
+    def publish(self, task_id):
+        with self.condition:
+            self.version += 1
+            self.changed[task_id] = self.version
+            self.changed.move_to_end(task_id)
+            while len(self.changed) > self.max_tracked:
+                _, version = self.changed.popitem(last=False)
+                self.all_changed_version = max(self.all_changed_version, version)
+            self.condition.notify_all()
+
+    def publish_all(self):
+        with self.condition:
+            self.version += 1
+            self.all_changed_version = self.version
+            self.condition.notify_all()
+
+    def _changed_since(self, task_ids, since):
+        if self.all_changed_version > since:
+            return list(task_ids)
+        return [task_id for task_id in task_ids if self.changed.get(task_id, 0) > since]
+
+    def wait(self, task_ids, since, timeout=None):
+        """
+        :return: (current version, task IDs that changed after `since`).
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self._changed_since(task_ids, since), timeout)
+            return self.version, self._changed_since(task_ids, since)
+
+
+class StatusChangeWatcher(ChangeStreamWatcher):
+    """
+    Forward status changes made by other processes (e.g. the dispatcher
+    claiming a task) from the Mongo change stream to a TaskStatusBroadcaster.
+    """
+    pipeline = [{"$match": {
+        "operationType": "update",
+        "updateDescription.updatedFields.status": {"$exists": True},
+    }}]
+    watch_options = {"full_document": "updateLookup"}
+
+    def handle(self, change):
+        document = change.get('fullDocument')
+        if document is None:
+            self.notifier.publish_all()
+        else:
+            self.notifier.publish(document['task_id'])
+
+
+class TaskWaiter:
+    """
+    Decide how long the dispatcher sleeps between queue checks.
+
+    After a productive iteration it returns at once. Otherwise it waits on
+    the notifier (fed by insert_task in this process and by the change stream)
+    with an exponentially growing timeout, so an idle queue costs few database
+    round trips while a new task is still picked up immediately.
+
+    :param notifier: TaskNotifier to wait on.
+    :param min_interval: First poll interval after the queue went idle, in seconds.
+    :param max_interval: Upper bound for the poll interval, in seconds.
+    :param factor: Growth factor of the interval on every idle iteration.
+    """
+    def __init__(self, notifier, min_interval=0.05, max_interval=1.0, factor=2.0):
+        self.notifier = notifier
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.interval = min_interval
+        self.version = notifier.version
+
+    def wait(self, productive):
+        if productive:
+            self.interval = self.min_interval
+            self.version = self.notifier.version
+            return
+        version = self.notifier.wait(self.version, self.interval)
+        if version != self.version:
+            self.interval = self.min_interval
+            self.version = version
+        else:
+            self.interval = min(self.interval * self.factor, self.max_interval)
@@ -1,10 +1,12 @@
 import argparse
-import time
-import json
-import os
-import requests
 
-from mongo_handler import TaskDatabase
+from mongo_handler import TaskDatabase, DEFAULT_MAX_ATTEMPTS
+from task_events import ChangeStreamWatcher, TaskWaiter
+from worker_registry import WorkerRegistry
+from dispatch_client import default_client
+from dispatch_scheduler import DispatchScheduler
+from scheduling_policy import FifoPolicy, FairSharePolicy, ShortestJobFirstPolicy, DeadlinePolicy
+from cost_model import ThroughputModel, QueueOrder
 from common import *
 
 def parse_arguments():
@@ -17,34 +19,43 @@ def parse_arguments():
     parser.add_argument("--check_api_method", default='get_worker_status', help="API method for checking worker status")
     parser.add_argument("--database_url", default='mongodb://localhost:27017/')
     parser.add_argument("--database_name", default='task_db')
+    parser.add_argument("--dispatch_mode", default='event', choices=['event', 'poll'],
+                        help="'event' wakes on new tasks with adaptive backoff, 'poll' checks every second")
+    parser.add_argument("--max_poll_interval", type=float, default=1.0,
+                        help="Upper bound of the backoff interval in event mode, in seconds; without a "
+                             "replica set no change stream wakes the dispatcher on tasks from other "
+                             "processes, so this is their worst-case pickup delay, kept at the poll mode's 1s")
+    parser.add_argument("--probe_interval", type=float, default=2.0, help="Seconds between worker status probes")
+    parser.add_argument("--probe_timeout", type=float, default=1.0, help="Timeout of a worker status probe, in seconds")
+    parser.add_argument("--metrics_every", type=int, default=20,
+                        help="Print dispatch latency stats every N dispatched tasks")
+    parser.add_argument("--max_concurrent_dispatches", type=int, default=8,
+                        help="Upper bound of dispatch requests sent concurrently")
+    parser.add_argument("--scheduling_policy", default='fifo', choices=['fifo', 'fair', 'sjf', 'deadline'],
+                        help="'fifo' oldest first, 'fair' priority classes with per-user round-robin, "
+                             "'sjf' shortest expected job first, "
+                             "'deadline' earliest deadline first, tasks that can no longer make it last")
+    parser.add_argument("--max_wait", type=float, default=600,
+                        help="With the fair and sjf policies, tasks waiting longer than this many seconds go first")
+    parser.add_argument("--model_refresh_interval", type=float, default=60,
+                        help="Seconds between updates of the per-worker throughput model from completed tasks")
+    parser.add_argument("--input_cache", default='offer', choices=['offer', 'off'],
+                        help="'offer' asks the worker for a cached copy of the input before uploading it")
+    parser.add_argument("--max_attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help="A task dispatched this many times without completing is marked failed")
     return parser.parse_args()
 
 
-def send_video_processing_request(task, server_url, response_url):
+def send_video_processing_request(task, server_url, response_url, client=default_client):
     """
     Send a video processing request to the server.
 
     :param task: A dictionary containing task details.
     :param server_url: URL of the video processing server.
     :param response_url: URL to send the processed video to.
+    :param client: DispatchClient holding the pooled per-worker sessions.
     """
-    video_path = task['original_video_path']
-    objects_info = json.dumps(task['objects'])  # Convert objects info to JSON string
-    animate_config = json.dumps(json.load(
-        open(task['config_path'], 'r')
-    ))
-    task_id = task['task_id']
-
-    files = {'video': open(video_path, 'rb')}
-    config_data = json.dumps({
-        'objects': objects_info,
-        'animate_config': animate_config,
-        'response_url': response_url,
-        'task_id': task_id,
-    })
-    data = {'config': config_data, 'response_url': response_url}
-    response = requests.post(server_url, files=files, data=data)
-    return response
+    return client.send_task(task, server_url, response_url)
 
 
 if __name__ == "__main__":
@@ -53,36 +64,44 @@ if __name__ == "__main__":
     
     try:
         # Initialize TaskDatabase with MongoDB connection details
-        task_db = TaskDatabase(args.database_url, args.database_name)
+        task_db = TaskDatabase(args.database_url, None, args.database_name)
+        task_db.ensure_indexes()
+
+        if args.dispatch_mode == 'event':
+            ChangeStreamWatcher(task_db.tasks, task_db.notifier).start()
+            waiter = TaskWaiter(task_db.notifier, max_interval=args.max_poll_interval)
+        else:
+            waiter = TaskWaiter(task_db.notifier, min_interval=1.0, max_interval=1.0, factor=1.0)
+        registry = WorkerRegistry(
+            args.adresses_path, args.worker_port, args.check_api_method,
+            probe_interval=args.probe_interval, timeout=args.probe_timeout,
+            notifier=task_db.notifier, task_db=task_db,
+        ).start()
+        default_client.offer_cached_input = args.input_cache == 'offer'
+        model = ThroughputModel(task_db, refresh_interval=args.model_refresh_interval)
+        if args.scheduling_policy == 'fair':
+            policy = FairSharePolicy(task_db, max_wait=args.max_wait)
+        elif args.scheduling_policy == 'sjf':
+            policy = ShortestJobFirstPolicy(task_db, max_wait=args.max_wait)
+        elif args.scheduling_policy == 'deadline':
+            policy = DeadlinePolicy(task_db, model=model)
+        else:
+            policy = FifoPolicy(task_db)
+        policy.ensure_indexes()
+        scheduler = DispatchScheduler(
+            task_db, registry, default_client, args.process_api_method, result_endpoint,
+            max_concurrency=args.max_concurrent_dispatches, metrics_every=args.metrics_every,
+            policy=policy, model=model, queue_order=QueueOrder(task_db), max_attempts=args.max_attempts,
+        )
+        dispatched = False
 
         while True:
-            time.sleep(1)
-            # Retrieve the oldest task from the 'waiting' collection
-            task = task_db.retrieve_oldest_wait_task()
-            if not task:
-                print('No task')
-                continue
-            print('Task found:', task['task_id'])
-            ip_addresses = read_servers_from_file(args.adresses_path)
-            
-            for ip_address in ip_addresses:
-                url = f'http://{ip_address}:{args.worker_port}'
-                print('Checking worker status at:', url)
-                response = requests.get(os.path.join(url, args.check_api_method))
-                status = json.loads(response.text)['status']
-                
-                if status == 'ready':
-                    print(f"Sending task {task['task_id']} to {url} for {args.process_api_method}")
-                    # Move task to 'in_progress' collection
-                    task_db.move_task_to_in_progress(task['task_id'], ip_address) 
-                    response = send_video_processing_request(
-                        task, os.path.join(url, args.process_api_method),
-                        result_endpoint
-                    )
-                    if response.status_code == 200:
-                        print(f"Task {task['task_id']} is being processed.")
-                    else:
-                        print(f"Failed to start task {task['task_id']}.")
+            waiter.wait(dispatched)
+            requeued = task_db.requeue_expired_tasks(max_attempts=args.max_attempts)
+            if requeued:
+                print(f'Re-queued {requeued} tasks with expired leases')
+            # Fill every free worker slot with the oldest waiting tasks
+            dispatched = scheduler.tick() > 0
 
     except KeyboardInterrupt:
         print("Shutting down...")
@@ -1,16 +1,27 @@
 import argparse
 from flask import Flask, jsonify, request, redirect, url_for, render_template
-from flask import send_from_directory
+from flask import send_file, Response
+import time
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import os
+import mimetypes
 import csv
 import json
+import math
 import uuid
+from datetime import datetime, timedelta
 from pathlib import Path
 from mongo_handler import TaskDatabase, TaskStatus  # Import your MongoDB TaskDatabase class and TaskStatus enum
 from functools import wraps
-from common import send_notification_to_popup
+from notification_service import NotificationService, APNsTransport, StubTransport
+from template_catalog import TemplateCatalog
+from chunked_upload import ChunkedUploadStore, UploadError
+from ingest import IngestPipeline
+from task_events import StatusChangeWatcher
+from storage_quota import StorageAccounting, EVICTION_POLICIES
+from content_store import ContentStore, hash_file
+from cost_model import ThroughputModel, QueueOrder, cost_features
 
 # Define Flask application
 app = Flask(__name__)
@@ -25,19 +36,87 @@ parser.add_argument('--flask_port', type=int, default=8100, help='Port for the F
 parser.add_argument('--flask_host', default='0.0.0.0', help='Host for the Flask server.')
 parser.add_argument('--blob_storage_path', type=str, default='files/blob_storage', help='Path to the blob storage directory.')
 parser.add_argument('--template_config_path', type=str, default='files/styles_config.json', help='Path to the template config')
+parser.add_argument('--effects_config_path', type=str, default='files/styles_effect_config.json', help='Path to the effects config')
+parser.add_argument('--templates_catalog_path', type=str, default='files/templates_config.json', help='Path to the expanded templates config')
+parser.add_argument('--watch_templates', action='store_true', help='Poll the template configs for changes in a background thread.')
 parser.add_argument('--styles_config_storage', type=str, default='files/configs', help='Path to the blob storage directory.')
+parser.add_argument('--accel_redirect_prefix', type=str, default=None,
+                    help='Internal nginx location mapped to the blob storage, enables X-Accel-Redirect offload.')
+parser.add_argument('--use_x_sendfile', action='store_true', help='Let the front server send files via X-Sendfile.')
+parser.add_argument('--result_max_age', type=int, default=3600, help='Cache-Control max-age of result files, in seconds.')
+parser.add_argument('--ingest_workers', type=int, default=2, help='Processes probing and normalizing uploads, 0 disables ingest.')
+parser.add_argument('--ingest_target_fps', type=float, default=None, help='Uploads above this frame rate are resampled to it.')
+parser.add_argument('--ingest_max_side', type=int, default=None, help='Uploads with a longer side are downscaled to it.')
+parser.add_argument('--ingest_max_duration', type=float, default=None, help='Uploads longer than this many seconds are trimmed.')
+parser.add_argument('--default_deadline', type=float, default=3600,
+                    help='Seconds after upload a task is due when the client requests no deadline.')
+parser.add_argument('--min_deadline', type=float, default=60,
+                    help="Shortest deadline any task can get, in seconds, even for users with a 'min_deadline_seconds' property.")
+parser.add_argument('--max_deadline', type=float, default=7 * 24 * 3600, help='Longest deadline a client can request, in seconds.')
+parser.add_argument('--status_max_wait', type=float, default=30, help='Longest /task_status long-poll, in seconds.')
+parser.add_argument('--status_stream_duration', type=float, default=300, help='Longest /task_status event stream, in seconds.')
+parser.add_argument('--status_recheck_interval', type=float, default=5,
+                    help='Without a change stream, re-read task status from Mongo this often while waiting.')
+parser.add_argument('--notifications', default='apns', choices=['apns', 'stub', 'off'],
+                    help="Push transport, 'stub' records notifications without sending them.")
+parser.add_argument('--apns_key_path', default='key.pem', help='APNs key file.')
+parser.add_argument('--apns_topic', default='com.example.App', help='APNs topic (app bundle id).')
+parser.add_argument('--apns_sandbox', action='store_true', help='Use the APNs sandbox environment.')
+parser.add_argument('--storage_high_water_gb', type=float, default=None,
+                    help='Evict done results when blob storage usage exceeds this, disabled by default.')
+parser.add_argument('--storage_low_water_ratio', type=float, default=0.9,
+                    help='Eviction stops below this fraction of the high-water mark.')
+parser.add_argument('--eviction_policy', default='lru', choices=list(EVICTION_POLICIES),
+                    help="'lru' by last result download or 'oldest_done'.")
 args = parser.parse_args()
 
 
 blob_storage = Path(args.blob_storage_path)
 blob_storage.mkdir(exist_ok=True)
 
+app.config['USE_X_SENDFILE'] = args.use_x_sendfile
+
 task_db = TaskDatabase(
     db_host=args.database_host,
     db_port=args.database_port,
     db_name=args.database_name
 )
 
+storage = StorageAccounting(
+    task_db,
+    blob_storage,
+    high_water_bytes=args.storage_high_water_gb * 1e9 if args.storage_high_water_gb else None,
+    low_water_ratio=args.storage_low_water_ratio,
+    policy=args.eviction_policy,
+)
+
+chunked_uploads = ChunkedUploadStore(blob_storage, storage=storage)
+
+content_store = ContentStore(task_db, blob_storage, storage)
+
+throughput_model = ThroughputModel(task_db)
+queue_order = QueueOrder(task_db)
+
+ingest_pipeline = None
+if args.ingest_workers > 0:
+    ingest_pipeline = IngestPipeline(
+        task_db,
+        max_workers=args.ingest_workers,
+        target_fps=args.ingest_target_fps,
+        max_side=args.ingest_max_side,
+        max_duration=args.ingest_max_duration,
+        storage=storage,
+        content_store=content_store,
+    )
+
+template_catalog = TemplateCatalog({
+    'styles': args.template_config_path,
+    'effects': args.effects_config_path,
+    'templates': args.templates_catalog_path,
+})
+if args.watch_templates:
+    template_catalog.start_watcher()
+
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,  # or any function that returns a unique identifier for each user
@@ -93,8 +172,44 @@ def store_apns():
 @app.route('/get_templates', methods=['GET'])
 @require_valid_uuid(task_db)
 def get_templates():
-    data = json.load(open(args.template_config_path, mode='r'))
-    return jsonify(data)
+    """
+    Serve a template catalog ('styles' by default, or ?catalog=effects|templates)
+    from its pre-serialized body, with 304 for clients holding the current ETag.
+    """
+    name = request.args.get('catalog', 'styles')
+    if name not in template_catalog.paths:
+        return jsonify({"error": f"Unknown catalog {name}"}), 404
+    entry = template_catalog.get(name)
+
+    if request.if_none_match.contains(entry.etag):
+        response = Response(status=304)
+    elif 'gzip' in request.accept_encodings:
+        response = Response(entry.gzip_body, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(entry.body, mimetype='application/json')
+    response.set_etag(entry.etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def serve_result_file(file_path):
+    """
+    Respond with a result file without copying it through Python.
+
+    With --accel_redirect_prefix the body is left to nginx via X-Accel-Redirect,
+    which then handles Range and conditional requests itself. Otherwise
+    send_file answers Range (206), If-None-Match / If-Modified-Since (304) from
+    the file stat and hands the file to wsgi.file_wrapper (sendfile).
+    """
+    if args.accel_redirect_prefix:
+        relative_path = os.path.relpath(file_path, args.blob_storage_path)
+        response = Response(status=200)
+        response.headers['X-Accel-Redirect'] = f"{args.accel_redirect_prefix.rstrip('/')}/{relative_path}"
+        response.headers['Content-Type'] = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        return response
+    return send_file(file_path, conditional=True, etag=True, max_age=args.result_max_age)
 
 
 @app.route('/get_task_result/<task_id>')
@@ -108,14 +223,15 @@ def get_task_result(task_id):
     file_path = task_db.get_file_path_by_task_id(task_id)
 
     if file_path:
-        filename = os.path.basename(file_path)  # Extract the filename
-        directory = os.path.dirname(file_path)  # Extract the directory path
-
         # Check if the file exists
         if os.path.isfile(file_path):
-            return send_from_directory(directory, filename)
-        else:
-            return jsonify({"error": "File not found"}), 404
+            storage.touch(task_id)
+            return serve_result_file(file_path)
+        task_db.result_path_cache.invalidate(task_id)
+    if storage.is_evicted(task_id):
+        return jsonify({"error": "Result was evicted from storage"}), 410
+    if file_path:
+        return jsonify({"error": "File not found"}), 404
     else:
         return jsonify({"error": "Task not found or no result available"}), 404
 
@@ -136,25 +252,79 @@ def upload_task():
     
     data = request.form['data']
     data = json.loads(data)
-    
-    token = data.get('token')
-    objects = data.get('objects')
-    config_text_box = data.get('config_text_box')
-    task_type = data.get('task_type')
-    
+    try:
+        task_deadline_seconds(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     task_id = str(uuid.uuid4())
     task_folder = blob_storage / task_id
     task_folder.mkdir(exist_ok=True)
     storage_video_path = str(task_folder / f'video.mp4')
-    storage_json_path = str(task_folder / f'config.json')
 
-    file.save(storage_video_path)
+    # Hash while saving, so the upload is only read once
+    content_digest, _ = content_store.save_stream(file.stream, storage_video_path)
+
+    return register_task(task_id, data, storage_video_path, content_digest)
+
+
+def task_deadline_seconds(data):
+    """
+    Seconds from upload until the task is due. Like priority, clients may relax
+    their deadline but tightening it is capped: it never goes below the user's
+    'min_deadline_seconds' property (the server default when unset) nor below
+    --min_deadline, and never above --max_deadline.
+    :raise ValueError: If the requested deadline is not a finite number.
+    """
+    try:
+        deadline_seconds = float(data.get('deadline_seconds', args.default_deadline))
+    except (TypeError, ValueError):
+        raise ValueError('deadline_seconds must be a number')
+    if not math.isfinite(deadline_seconds):
+        raise ValueError('deadline_seconds must be finite')
+    user_minimum = task_db.get_user_db_property(data.get('token'), 'min_deadline_seconds')
+    minimum = max(float(user_minimum) if user_minimum is not None else args.default_deadline, args.min_deadline)
+    return min(max(deadline_seconds, minimum), args.max_deadline)
+
+
+def register_task(task_id, data, storage_video_path, content_digest=None):
+    """
+    Store the task config next to the uploaded video, deduplicate the video
+    in the content store and queue the task.
+    :param content_digest: SHA-256 of the video if it was computed during the upload.
+    """
+    token = data.get('token')
+    objects = data.get('objects')
+    config_text_box = data.get('config_text_box')
+    task_type = data.get('task_type')
+
+    storage_json_path = str(blob_storage / task_id / f'config.json')
 
     with open(storage_json_path, 'w') as file:
         json.dump(
             config_text_box, file, indent=4
         )
 
+    # Users may lower their task's priority, raising it is capped by their 'max_priority'
+    try:
+        priority = int(data.get('priority', 0))
+    except (TypeError, ValueError):
+        priority = 0
+    priority = min(priority, int(task_db.get_user_db_property(token, 'max_priority') or 0))
+    # Validated when the upload started
+    deadline = (datetime.now() + timedelta(seconds=task_deadline_seconds(data))).isoformat()
+
+    if content_digest is None:
+        content_digest = hash_file(storage_video_path)
+    deduplicated = content_store.add(storage_video_path, content_digest, token)
+    cost = None
+    if not ingest_pipeline:
+        # Without the ingest stage nothing else probes the video
+        try:
+            cost = cost_features(storage_video_path, objects)
+        except Exception as e:
+            print(f"Could not probe the video of task {task_id}: {e}")
+
     # Insert task into the MongoDB database
     task_id = task_db.insert_task(
         objects=objects,
@@ -162,15 +332,262 @@ def upload_task():
         config_path=storage_json_path,
         task_type=task_type,
         user_id=token,
+        task_id=task_id,
+        status=TaskStatus.INGESTING if ingest_pipeline else TaskStatus.WAITING,
+        content_digest=content_digest,
+        priority=priority,
+        cost=cost,
+        deadline=deadline,
     )
+    # The video is accounted once per blob by the content store
+    storage.maybe_evict()
+    if ingest_pipeline:
+        ingest_pipeline.submit(task_id, storage_video_path)
 
     result = {
         'message': f'Task {task_id} uploaded and saved successfully',
         'task_id': task_id,
+        'content_digest': content_digest,
+        'deduplicated': deduplicated,
     }
     return jsonify(result), 200
 
 
+def upload_error_response(e):
+    return jsonify({'error': e.message}), e.status
+
+
+@app.route('/upload_task/init', methods=['POST'])
+@require_valid_uuid(task_db)
+@limiter.limit("10 per minute")
+def upload_task_init():
+    """
+    Start a resumable upload. Expects the same 'data' field as /upload_task
+    plus 'size', the video size in bytes. Chunks are then sent with
+    PUT /upload_task/<upload_id> and a Content-Range header, and the task is
+    queued by POST /upload_task/<upload_id>/finalize.
+    """
+    if 'data' not in request.form or 'size' not in request.form:
+        return jsonify({'error': 'Both data and size are required'}), 400
+    try:
+        data = json.loads(request.form['data'])
+        size = int(request.form['size'])
+        task_deadline_seconds(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    upload_id = str(uuid.uuid4())
+    try:
+        state = chunked_uploads.init(upload_id, request.headers.get('token'), data, size)
+    except UploadError as e:
+        return upload_error_response(e)
+    storage.maybe_evict()
+    return jsonify({'upload_id': upload_id, 'offset': state['offset'], 'size': state['size']}), 200
+
+
+@app.route('/upload_task/<upload_id>', methods=['GET'])
+@require_valid_uuid(task_db)
+@limiter.limit("600 per minute")
+def upload_task_status(upload_id):
+    """
+    Report how many bytes were received, the client resumes from 'offset'.
+    """
+    try:
+        state = chunked_uploads.status(upload_id, request.headers.get('token'))
+    except UploadError as e:
+        return upload_error_response(e)
+    return jsonify({'upload_id': upload_id, 'offset': state['offset'], 'size': state['size']}), 200
+
+
+@app.route('/upload_task/<upload_id>', methods=['PUT'])
+@require_valid_uuid(task_db)
+@limiter.limit("600 per minute")
+def upload_task_chunk(upload_id):
+    """
+    Receive one chunk as the raw request body with 'Content-Range: bytes start-end/total'
+    and an optional 'X-Chunk-CRC32' header.
+    """
+    content_range = request.headers.get('Content-Range', '')
+    try:
+        unit, byte_range = content_range.split(' ', 1)
+        span, total = byte_range.split('/', 1)
+        start, end = span.split('-', 1)
+        start, end, total = int(start), int(end), int(total)
+        chunk_crc32 = request.headers.get('X-Chunk-CRC32')
+        chunk_crc32 = int(chunk_crc32) if chunk_crc32 is not None else None
+    except ValueError:
+        return jsonify({'error': 'Expected Content-Range: bytes start-end/total'}), 400
+    if unit != 'bytes':
+        return jsonify({'error': 'Only byte ranges are supported'}), 400
+
+    try:
+        state = chunked_uploads.write_chunk(
+            upload_id, request.headers.get('token'), start, end, total,
+            request.stream, chunk_crc32,
+        )
+    except UploadError as e:
+        return upload_error_response(e)
+    return jsonify({'upload_id': upload_id, 'offset': state['offset'], 'size': state['size']}), 200
+
+
+@app.route('/upload_task/<upload_id>/finalize', methods=['POST'])
+@require_valid_uuid(task_db)
+@limiter.limit("10 per minute")
+def upload_task_finalize(upload_id):
+    """
+    Verify the upload (optionally against a 'crc32' form field) and queue the task.
+    """
+    try:
+        crc32 = request.form.get('crc32')
+        crc32 = int(crc32) if crc32 is not None else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        state, storage_video_path = chunked_uploads.finalize(
+            upload_id, request.headers.get('token'), crc32
+        )
+    except UploadError as e:
+        return upload_error_response(e)
+    return register_task(upload_id, state['data'], storage_video_path)
+
+
+status_watcher = StatusChangeWatcher(task_db.tasks, task_db.status_events)
+
+notification_service = None
+if args.notifications != 'off':
+    if args.notifications == 'apns':
+        transport = APNsTransport(args.apns_key_path, use_sandbox=args.apns_sandbox)
+    else:
+        transport = StubTransport()
+    notification_service = NotificationService(
+        transport, topic=args.apns_topic, on_invalid_token=task_db.remove_push_token,
+    )
+
+
+def task_eta(task):
+    """
+    Expected seconds until the task is done, from the throughput model, None without data.
+    """
+    units = (task.get('cost') or {}).get('units')
+    if task['status'] == TaskStatus.WAITING.state:
+        count, units_ahead = queue_order.ahead(task['task_id'])
+        return count, throughput_model.queue_eta(count, units_ahead, units)
+    if task['status'] == TaskStatus.IN_PROGRESS.state and task.get('claimed_at'):
+        expected = throughput_model.predict(units, task.get('machine_ip'))
+        if expected is None:
+            return None, None
+        elapsed = (datetime.now() - datetime.fromisoformat(task['claimed_at'])).total_seconds()
+        return None, max(expected - elapsed, 0)
+    return None, None
+
+
+def task_status_snapshot(task_ids, user_id):
+    """
+    Status, assigned worker, queue position and ETA of the user's tasks, with
+    one $in query; queue positions come from the order the dispatcher publishes.
+    """
+    throughput_model.maybe_refresh()
+    tasks = task_db.get_tasks(
+        task_ids, fields=['status', 'timestamp', 'machine_ip', 'user_id', 'cost', 'claimed_at']
+    )
+    snapshot = {}
+    for task_id in task_ids:
+        task = tasks.get(task_id)
+        if task is None or task.get('user_id') != user_id:
+            snapshot[task_id] = {'status': 'not_found'}
+            continue
+        entry = {'status': task['status'], 'worker': task.get('machine_ip')}
+        queue_position, eta = task_eta(task)
+        if task['status'] == TaskStatus.WAITING.state:
+            entry['queue_position'] = queue_position
+        if task['status'] in (TaskStatus.WAITING.state, TaskStatus.IN_PROGRESS.state):
+            entry['eta'] = round(eta) if eta is not None else None
+        snapshot[task_id] = entry
+    return snapshot
+
+
+def status_fields(snapshot):
+    # The ETA moves with the clock, only status changes wake a waiting client
+    return {task_id: {k: v for k, v in entry.items() if k != 'eta'} for task_id, entry in snapshot.items()}
+
+
+def wait_for_status_change(task_ids, user_id, since, snapshot, timeout):
+    """
+    Block until one of the tasks changes or the timeout expires.
+    :return: (version, new snapshot or None if nothing changed).
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return since, None
+        if not status_watcher.available:
+            # Changes made by other processes are only seen by re-reading
+            remaining = min(remaining, args.status_recheck_interval)
+        version, changed = task_db.status_events.wait(task_ids, since, remaining)
+        if changed or not status_watcher.available:
+            current = task_status_snapshot(task_ids, user_id)
+            if status_fields(current) != status_fields(snapshot):
+                return version, current
+        since = version
+
+
+def status_event_stream(task_ids, user_id, since, snapshot):
+    finished = {TaskStatus.DONE.state, TaskStatus.FAILED.state, 'not_found'}
+    yield f"id: {since}\ndata: {json.dumps(snapshot)}\n\n"
+    deadline = time.monotonic() + args.status_stream_duration
+    while time.monotonic() < deadline:
+        if all(entry['status'] in finished for entry in snapshot.values()):
+            return
+        since, current = wait_for_status_change(task_ids, user_id, since, snapshot, args.status_max_wait)
+        if current is None:
+            # Keep proxies from closing an idle connection
+            yield ": keep-alive\n\n"
+            continue
+        snapshot = current
+        yield f"id: {since}\ndata: {json.dumps(snapshot)}\n\n"
+
+
+@app.route('/task_status', methods=['GET'])
+@require_valid_uuid(task_db)
+@limiter.limit("120 per minute")
+def task_status():
+    """
+    Report status, queue position, assigned worker and ETA in seconds of one
+    or more tasks (?task_ids=a,b). With ?since=<version>&wait=<seconds> the request is held
+    until one of the tasks changes (long-poll); with Accept: text/event-stream
+    updates are pushed as Server-Sent Events until all tasks are done.
+    """
+    task_ids = [task_id for task_id in request.args.get('task_ids', '').split(',') if task_id]
+    if not task_ids:
+        return jsonify({'error': 'task_ids is required'}), 400
+    user_id = request.headers.get('token')
+    try:
+        since = request.args.get('since', type=int)
+        wait = min(float(request.args.get('wait', args.status_max_wait)), args.status_max_wait)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    version = task_db.status_events.version
+    snapshot = task_status_snapshot(task_ids, user_id)
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        return Response(
+            status_event_stream(task_ids, user_id, version, snapshot),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        )
+
+    if since is not None and wait > 0:
+        _, changed = task_db.status_events.wait(task_ids, min(since, version), timeout=0)
+        # Anything that changed since the client's version is already in the snapshot
+        if not changed:
+            changed_version, current = wait_for_status_change(task_ids, user_id, version, snapshot, wait)
+            if current is not None:
+                version, snapshot = changed_version, current
+    return jsonify({'version': version, 'tasks': snapshot}), 200
+
+
 @app.route('/process_video_result', methods=['POST'])
 @require_valid_uuid(task_db)
 @limiter.limit("10 per minute")
@@ -179,24 +596,43 @@ def process_video_result():
     video_file = request.files['video']
 
     task_dir = Path(args.blob_storage_path) / task_id
+    created_dir = not task_dir.exists()
     task_dir.mkdir(exist_ok=True)
     video_path = os.path.join(str(task_dir), task_id + '_' + video_file.filename)
+    # A late duplicate must not overwrite the accepted result, so save under a unique name first
+    tmp_path = os.path.join(str(task_dir), f'.{uuid.uuid4().hex}.part')
     
     # Save video in blob storage
-    video_file.save(video_path)
+    video_file.save(tmp_path)
 
     # Update task in MongoDB
-    # task_db.move_task_to_done(task_id, video_path)
+    if not task_db.move_task_to_done(task_id, video_path):
+        # Unknown task, or a late duplicate of a result that was already accepted
+        os.remove(tmp_path)
+        if created_dir:
+            task_dir.rmdir()
+        return jsonify({'error': f'Task {task_id} is not waiting for a result'}), 409
+    os.replace(tmp_path, video_path)
+    storage.record_size(task_id, 'result_bytes', os.path.getsize(video_path))
+    storage.maybe_evict()
 
     user_id = task_db.get_user_id_by_task_id(task_id)
 
     apns_token = task_db.get_user_db_property(user_id, 'apns_token')
 
-    print(f'send_notification_to_popup with {apns_token}')
-    # send_notification_to_popup(apns_token, f'process video result for task {task_id}')
+    if apns_token and notification_service:
+        notification_service.enqueue(apns_token, f'process video result for task {task_id}')
 
     return jsonify({'message': 'Video processed and task updated successfully'}), 200
 
 
 if __name__ == '__main__':
+    task_db.ensure_indexes()
+    storage.ensure_indexes()
+    task_db.migrate_legacy_collections()
+    if ingest_pipeline:
+        ingest_pipeline.resume_pending()
+    status_watcher.start()
+    if notification_service:
+        notification_service.start()
     app.run(host=args.flask_host, port=args.flask_port)
\ No newline at end of file
@@ -0,0 +1,90 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import threading
+
+
+class CatalogEntry:
+    """
+    One parsed JSON config with its response body pre-serialized, pre-gzipped
+    and tagged with an ETag derived from the body.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime_ns
+        with open(path, 'r') as f:
+            self.data = json.load(f)
+        self.body = json.dumps(self.data, separators=(',', ':')).encode('utf-8')
+        self.gzip_body = gzip.compress(self.body, compresslevel=9)
+        self.etag = hashlib.sha1(self.body).hexdigest()
+
+
+class TemplateCatalog:
+    """
+    In-memory cache of the template, style and effect configs served to the app.
+
+    Files are parsed once and re-read only when their mtime changes. Without
+    the watcher, the mtime is checked on access at most every `check_interval`
+    seconds. With start_watcher() a background thread polls the files instead
+    and the request path does no file system access at all.
+
+    :param paths: Mapping of catalog names to JSON file paths.
+    :param check_interval: Seconds between two mtime checks of a file.
+    """
+    def __init__(self, paths, check_interval=1.0):
+        self.paths = dict(paths)
+        self.check_interval = check_interval
+        self.entries = {}
+        self.checked_at = {}
+        self.lock = threading.Lock()
+        self.watching = False
+        self.stopped = threading.Event()
+        for name in self.paths:
+            self.reload(name)
+
+    def reload(self, name):
+        """
+        Re-read the file behind `name` if its mtime changed.
+        :return: True if the entry was reloaded.
+        """
+        path = self.paths[name]
+        current = self.entries.get(name)
+        self.checked_at[name] = time.monotonic()
+        try:
+            if current is not None and os.stat(path).st_mtime_ns == current.mtime:
+                return False
+            entry = CatalogEntry(path)
+        except (OSError, ValueError) as e:
+            if current is None:
+                raise
+            # Keep serving the previous version while the file is being rewritten
+            print(f"Failed to reload {path}: {e}")
+            return False
+        with self.lock:
+            self.entries[name] = entry
+        print(f"Loaded template catalog '{name}' from {path}")
+        return True
+
+    def get(self, name):
+        if not self.watching and time.monotonic() - self.checked_at[name] >= self.check_interval:
+            self.reload(name)
+        return self.entries[name]
+
+    def watch(self):
+        while not self.stopped.wait(self.check_interval):
+            for name in self.paths:
+                try:
+                    self.reload(name)
+                except OSError as e:
+                    print(f"Failed to check {self.paths[name]}: {e}")
+
+    def start_watcher(self):
+        self.watching = True
+        threading.Thread(target=self.watch, daemon=True).start()
+        return self
+
+    def stop_watcher(self):
+        self.stopped.set()
+        self.watching = False
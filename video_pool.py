@@ -0,0 +1,237 @@
+import os
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+import cv2
+
+
+VideoMetadata = namedtuple(
+    'VideoMetadata', ['frame_count', 'fps', 'width', 'height', 'codec']
+)
+# What cv2 reports for a file it cannot open
+EMPTY_METADATA = VideoMetadata(frame_count=0, fps=0.0, width=0, height=0, codec='')
+
+
+def decode_fourcc(value):
+    value = int(value)
+    return ''.join(chr((value >> 8 * i) & 0xFF) for i in range(4)).strip('\x00')
+
+
+def read_capture_metadata(capture):
+    return VideoMetadata(
+        frame_count=int(capture.get(cv2.CAP_PROP_FRAME_COUNT)),
+        fps=capture.get(cv2.CAP_PROP_FPS),
+        width=int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        height=int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        codec=decode_fourcc(capture.get(cv2.CAP_PROP_FOURCC)),
+    )
+
+
+class PooledCapture:
+    """
+    An open cv2.VideoCapture together with the lock that guards it and the
+    position of the next frame it will decode, so sequential reads skip the seek.
+    `users` counts the acquire calls holding or waiting for it, under the pool lock.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.capture = cv2.VideoCapture(path)
+        self.lock = threading.Lock()
+        self.position = 0
+        self.last_used = time.monotonic()
+        self.users = 0
+
+    def is_opened(self):
+        return self.capture.isOpened()
+
+    def read(self, frame_number):
+        if frame_number != self.position:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+        success, image = self.capture.read()
+        self.position = frame_number + 1 if success else -1
+        return success, image
+
+    def release(self):
+        with self.lock:
+            self.capture.release()
+
+
+class VideoCapturePool:
+    """
+    Process-wide LRU pool of open video captures keyed by (path, mtime).
+
+    Alongside the handles it keeps a metadata cache and a cache of decoded
+    first frames, so repeated queries for the same file only cost an os.stat.
+    A file that is rewritten gets a new mtime and therefore a fresh entry.
+    Metadata-only reads do not keep a capture open.
+
+    A daemon thread, started with the first capture, runs evict_idle every
+    `sweep_interval` seconds, so a quiet process does not keep descriptors
+    on files that were deleted or rewritten since.
+
+    :param max_handles: Maximum number of captures kept open.
+    :param idle_timeout: Seconds after which an unused capture is released.
+    :param max_cached: Maximum number of metadata and thumbnail entries.
+    :param sweep_interval: Seconds between two evict_idle runs of the sweeper thread.
+    """
+    def __init__(self, max_handles=16, idle_timeout=300, max_cached=256, sweep_interval=60):
+        self.max_handles = max_handles
+        self.idle_timeout = idle_timeout
+        self.max_cached = max_cached
+        self.sweep_interval = sweep_interval
+        self.lock = threading.Lock()
+        self.handles = OrderedDict()
+        self.metadata_cache = OrderedDict()
+        self.thumbnail_cache = OrderedDict()
+        self.sweeper = None
+
+    @staticmethod
+    def make_key(video_path):
+        path = os.path.abspath(video_path)
+        return path, os.stat(path).st_mtime_ns
+
+    def _cache_get(self, cache, key):
+        with self.lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+
+    def _cache_put(self, cache, key, value):
+        with self.lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > self.max_cached:
+                cache.popitem(last=False)
+
+    def _collect_evictions(self, now, stale_keys=()):
+        """
+        Pop handles over the count limit, idle for too long or stale. Caller holds self.lock.
+        Handles in use are never evicted, the pool goes over the limit until they are returned.
+        """
+        evicted = []
+        for key in list(self.handles):
+            handle = self.handles[key]
+            over_count = len(self.handles) > self.max_handles
+            if not over_count and now - handle.last_used < self.idle_timeout and key not in stale_keys:
+                continue
+            if handle.users:
+                continue
+            evicted.append(self.handles.pop(key))
+        return evicted
+
+    @contextmanager
+    def acquire(self, video_path):
+        """
+        Yield a locked PooledCapture for video_path, opening it if needed.
+        """
+        key = self.make_key(video_path)
+        now = time.monotonic()
+        with self.lock:
+            handle = self.handles.get(key)
+            if handle is None:
+                handle = PooledCapture(key[0])
+                self.handles[key] = handle
+            self.handles.move_to_end(key)
+            handle.last_used = now
+            # Pinned before the pool lock is released, so no eviction can close it under us
+            handle.users += 1
+            evicted = self._collect_evictions(now)
+            if self.sweeper is None:
+                self.sweeper = threading.Thread(target=self._sweep, daemon=True)
+                self.sweeper.start()
+        try:
+            for stale in evicted:
+                stale.release()
+            with handle.lock:
+                yield handle
+                handle.last_used = time.monotonic()
+        finally:
+            with self.lock:
+                handle.users -= 1
+
+    def metadata(self, video_path):
+        try:
+            key = self.make_key(video_path)
+        except FileNotFoundError:
+            return EMPTY_METADATA
+        metadata = self._cache_get(self.metadata_cache, key)
+        if metadata is None:
+            with self.lock:
+                pooled = key in self.handles
+            if pooled:
+                with self.acquire(video_path) as handle:
+                    metadata = read_capture_metadata(handle.capture)
+            else:
+                # Probing only needs the header, do not keep a descriptor open for it
+                capture = cv2.VideoCapture(key[0])
+                try:
+                    metadata = read_capture_metadata(capture)
+                finally:
+                    capture.release()
+            self._cache_put(self.metadata_cache, key, metadata)
+        return metadata
+
+    def read_frame(self, video_path, frame_number, color_code=cv2.COLOR_BGR2RGB):
+        with self.acquire(video_path) as handle:
+            success, image = handle.read(frame_number)
+        if not success:
+            return None
+        return cv2.cvtColor(image, color_code) if color_code is not None else image
+
+    def thumbnail(self, video_path):
+        """
+        Return the decoded first frame in RGB. The array is shared between
+        callers and therefore read-only, copy it before drawing on it.
+        """
+        key = self.make_key(video_path)
+        image = self._cache_get(self.thumbnail_cache, key)
+        if image is None:
+            image = self.read_frame(video_path, 0)
+            if image is None:
+                return None
+            image.setflags(write=False)
+            self._cache_put(self.thumbnail_cache, key, image)
+        return image
+
+    def evict_idle(self):
+        """
+        Release idle captures and those whose file was deleted or rewritten.
+        :return: Number of released captures.
+        """
+        with self.lock:
+            keys = list(self.handles)
+        stale_keys = set()
+        for key in keys:
+            try:
+                if os.stat(key[0]).st_mtime_ns != key[1]:
+                    stale_keys.add(key)
+            except OSError:
+                stale_keys.add(key)
+        with self.lock:
+            evicted = self._collect_evictions(time.monotonic(), stale_keys)
+        for handle in evicted:
+            handle.release()
+        return len(evicted)
+
+    def _sweep(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.evict_idle()
+            except Exception as e:
+                print(f"Video pool sweep failed: {e}")
+
+    def clear(self):
+        with self.lock:
+            handles = list(self.handles.values())
+            self.handles.clear()
+            self.metadata_cache.clear()
+            self.thumbnail_cache.clear()
+        for handle in handles:
+            handle.release()
+
+
+video_pool = VideoCapturePool()
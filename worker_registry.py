@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from common import read_servers_from_file
+from mongo_handler import DEFAULT_LEASE_SECONDS
+
+
+class WorkerState:
+    """
+    Last known state of one worker as seen by the registry.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.status = None
+        self.checked_at = 0.0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        # Content digests of inputs the worker holds, most recent last
+        self.cached_inputs = OrderedDict()
+        # Task slots as advertised by the worker, and dispatches not answered yet
+        self.capacity = 1
+        self.running = 0
+        self.in_flight = 0
+        self.leases_renewed_at = 0.0
+
+    def free_slots(self):
+        return max(self.capacity - self.running - self.in_flight, 0)
+
+    def is_circuit_open(self, now):
+        return now < self.open_until
+
+
+class WorkerRegistry:
+    """
+    Cached view of the worker fleet for the dispatcher.
+
+    A background thread probes every worker's status endpoint concurrently
+    with strict timeouts, so the dispatch loop only reads the in-memory ready
+    set. Hosts failing `failure_threshold` probes in a row are skipped for
+    `cooldown` seconds (circuit breaker). The addresses file is re-read only
+    when its mtime changes.
+
+    Workers advertise `capacity` (task slots) and `running` in their status;
+    a worker reporting only 'ready' or 'busy' counts as one slot. Slots
+    handed out by acquire_slot stay taken until the dispatch is answered and
+    a later probe reports the worker's own count.
+
+    The registry also remembers which inputs each worker holds, from the
+    `cached_inputs` list of its status when it reports one and otherwise from
+    the videos dispatched to it, so tasks can be sent where their input is.
+
+    With a `task_db`, the probe doubles as a heartbeat: the leases of the task
+    ids a worker lists in `running_tasks` are renewed, so a long job is not
+    re-queued while it is still running.
+
+    :param adresses_path: File with one worker address per line.
+    :param worker_port: Port the workers listen on.
+    :param check_api_method: Name of the worker status endpoint.
+    :param probe_interval: Seconds between two probe rounds.
+    :param timeout: Connect and read timeout of a single probe, in seconds.
+    :param ttl: Seconds after which a cached status is no longer trusted.
+    :param failure_threshold: Consecutive failed probes that open the circuit.
+    :param cooldown: Seconds a host with an open circuit is not probed.
+    :param notifier: Optional TaskNotifier woken when a worker becomes ready.
+    :param max_cached_inputs: Input digests remembered per worker.
+    :param task_db: Optional TaskDatabase whose leases are renewed from the probes.
+    :param lease_seconds: Lease given to the tasks a worker reports running.
+    :param lease_renew_interval: Seconds between two lease renewals of one worker.
+    """
+    def __init__(
+            self,
+            adresses_path,
+            worker_port,
+            check_api_method='get_worker_status',
+            probe_interval=2.0,
+            timeout=1.0,
+            ttl=5.0,
+            failure_threshold=3,
+            cooldown=30.0,
+            max_probe_threads=16,
+            notifier=None,
+            max_cached_inputs=1000,
+            task_db=None,
+            lease_seconds=DEFAULT_LEASE_SECONDS,
+            lease_renew_interval=60.0,
+        ):
+        self.adresses_path = adresses_path
+        self.worker_port = worker_port
+        self.check_api_method = check_api_method
+        self.probe_interval = probe_interval
+        self.timeout = timeout
+        self.ttl = ttl
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.notifier = notifier
+        self.max_cached_inputs = max_cached_inputs
+        self.task_db = task_db
+        self.lease_seconds = lease_seconds
+        self.lease_renew_interval = lease_renew_interval
+        self.workers = {}
+        self.addresses_mtime = None
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_probe_threads)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def worker_url(self, address):
+        return f'http://{address}:{self.worker_port}'
+
+    def reload_addresses(self):
+        """
+        Re-read the addresses file if its mtime changed.
+        :return: True if the worker list was reloaded.
+        """
+        mtime = os.stat(self.adresses_path).st_mtime_ns
+        if mtime == self.addresses_mtime:
+            return False
+        addresses = read_servers_from_file(self.adresses_path)
+        with self.lock:
+            self.workers = {
+                address: self.workers.get(address) or WorkerState(address)
+                for address in addresses
+            }
+            self.addresses_mtime = mtime
+        print(f'Loaded {len(addresses)} worker addresses from {self.adresses_path}')
+        return True
+
+    def fetch_status(self, address):
+        url = os.path.join(self.worker_url(address), self.check_api_method)
+        response = requests.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return json.loads(response.text)
+
+    def probe(self, worker):
+        try:
+            response = self.fetch_status(worker.address)
+            status = response['status']
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self.record_failure(worker, e)
+            return
+        cached_inputs = response.get('cached_inputs')
+        try:
+            capacity = max(int(response.get('capacity', 1)), 0)
+            running = int(response['running']) if 'running' in response else (0 if status == 'ready' else capacity)
+        except (TypeError, ValueError) as e:
+            self.record_failure(worker, e)
+            return
+        with self.lock:
+            if cached_inputs is not None:
+                worker.cached_inputs = OrderedDict.fromkeys(cached_inputs[-self.max_cached_inputs:])
+            had_free_slots = worker.status is not None and worker.free_slots() > 0
+            worker.capacity = capacity
+            worker.running = running
+            worker.status = status
+            became_ready = worker.free_slots() > 0 and not had_free_slots
+            worker.checked_at = time.monotonic()
+            worker.consecutive_failures = 0
+            worker.open_until = 0.0
+        if became_ready and self.notifier is not None:
+            self.notifier.notify()
+        self.renew_leases(worker, response.get('running_tasks'))
+
+    def renew_leases(self, worker, task_ids):
+        if self.task_db is None or not task_ids:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if now - worker.leases_renewed_at < self.lease_renew_interval:
+                return
+            worker.leases_renewed_at = now
+        try:
+            self.task_db.renew_leases(task_ids, worker.address, self.lease_seconds)
+        except Exception as e:
+            # A database hiccup is not the worker's failure
+            print(f'Renewing the leases of worker {worker.address} failed: {e}')
+
+    def record_failure(self, worker, error):
+        now = time.monotonic()
+        with self.lock:
+            worker.status = None
+            worker.checked_at = now
+            worker.consecutive_failures += 1
+            if worker.consecutive_failures >= self.failure_threshold:
+                worker.open_until = now + self.cooldown
+                print(f'Worker {worker.address} failed {worker.consecutive_failures} probes, '
+                      f'skipping it for {self.cooldown}s: {error}')
+
+    def probe_all(self):
+        """
+        Probe every worker whose circuit is closed, concurrently, and wait for the round.
+        """
+        now = time.monotonic()
+        with self.lock:
+            workers = [w for w in self.workers.values() if not w.is_circuit_open(now)]
+        list(self.executor.map(self.probe, workers))
+
+    def free_slots(self):
+        """
+        Free task slots of every worker with a fresh probe, as address -> count. No network I/O.
+        """
+        now = time.monotonic()
+        with self.lock:
+            slots = {
+                w.address: w.free_slots() for w in self.workers.values()
+                if w.status is not None
+                and now - w.checked_at <= self.ttl
+                and not w.is_circuit_open(now)
+            }
+        return {address: count for address, count in slots.items() if count > 0}
+
+    def acquire_slot(self, address):
+        """
+        Take one slot of `address` for a dispatch that is about to be sent.
+        """
+        with self.lock:
+            worker = self.workers.get(address)
+            if worker is not None:
+                worker.in_flight += 1
+
+    def finish_dispatch(self, address, accepted):
+        """
+        Give back the slot of an answered dispatch. An accepted task keeps it
+        as running until the next probe reports the worker's own count.
+        """
+        with self.lock:
+            worker = self.workers.get(address)
+            if worker is None:
+                return
+            worker.in_flight = max(worker.in_flight - 1, 0)
+            if accepted:
+                worker.running += 1
+
+    def mark_busy(self, address):
+        """
+        Record locally that `address` has no free slot, until the next probe says otherwise.
+        """
+        with self.lock:
+            worker = self.workers.get(address)
+            if worker is not None:
+                worker.status = 'busy'
+                worker.running = worker.capacity
+
+    def record_input(self, address, content_digest):
+        """
+        Remember that `address` received (or already held) the input with this digest.
+        """
+        if not content_digest:
+            return
+        with self.lock:
+            worker = self.workers.get(address)
+            if worker is None:
+                return
+            worker.cached_inputs[content_digest] = True
+            worker.cached_inputs.move_to_end(content_digest)
+            while len(worker.cached_inputs) > self.max_cached_inputs:
+                worker.cached_inputs.popitem(last=False)
+
+    def pick_worker(self, addresses, content_digest=None):
+        """
+        Cache-affinity choice among ready workers: the first one holding the
+        input, otherwise the first one.
+        """
+        if not addresses:
+            return None
+        if content_digest:
+            with self.lock:
+                for address in addresses:
+                    worker = self.workers.get(address)
+                    if worker is not None and content_digest in worker.cached_inputs:
+                        return address
+        return addresses[0]
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.reload_addresses()
+                self.probe_all()
+            except Exception as e:
+                print(f'Worker probing failed: {e}')
+            self.stopped.wait(self.probe_interval)
+
+    def start(self):
+        self.reload_addresses()
+        self.probe_all()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=False)